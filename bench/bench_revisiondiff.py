@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Measures the peak memory and time of comparing a client's have list against the files in
+# its last synced changelist, the way p4shelf.findFileRevisions does it. The listings are 
+# synthesized, so no perforce server is needed.
+#
+#   python bench/bench_revisiondiff.py [file counts...]
+#
+# Every measurement runs in its own process so that the peak RSS is not polluted by the
+# previous run. Needs the resource module, so it only works on unix like systems.
+#
+import os
+import sys
+import time
+import subprocess
+
+sys.path.append( os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src') )
+import p4shelf
+
+DEFAULT_COUNTS = [10000, 100000, 1000000]
+
+def listing(count, haveList):
+	"""
+		Yields (name, revision) sorted by name. Every 100th file differs between the two 
+		listings, and every 1000th is only present in one of them.
+	"""
+	for i in xrange(count):
+		if i % 1000 == 0 and haveList:
+			continue
+		rev = 3
+		if i % 100 == 0 and haveList:
+			rev = 2
+		yield '//depot/project/dir%05d/file%08d.cpp' % (i / 100, i), rev
+
+def runLists(count):
+	changefiles = list(listing(count, 0))
+	havefiles = list(listing(count, 1))
+	return len(p4shelf.calcRevisionDiff(changefiles, havefiles))
+
+def runMerge(count):
+	return len(list(p4shelf.mergeRevisionDiff(listing(count, 0), listing(count, 1))))
+
+def measure(method, count):
+	import resource
+	startTime = time.time()
+	if 'lists' == method:
+		diffs = runLists(count)
+	else:
+		diffs = runMerge(count)
+	elapsed = time.time() - startTime
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if 'darwin' == sys.platform:
+		peak = peak / 1024
+	print '%d %.2f %d' % (peak, elapsed, diffs)
+
+def main(argv):
+	if len(argv) == 3 and '--measure' == argv[0]:
+		measure(argv[1], int(argv[2]))
+		return 0
+	
+	counts = map(int, argv) or DEFAULT_COUNTS
+	print '%10s %-6s %12s %9s %9s' % ('files', 'method', 'peak rss kb', 'seconds', 'diffs')
+	for count in counts:
+		for method in ['lists', 'merge']:
+			output = subprocess.Popen( [sys.executable, os.path.abspath(__file__), '--measure', method, str(count)], 
+				stdout=subprocess.PIPE ).communicate()[0]
+			peak, elapsed, diffs = output.split()
+			print '%10d %-6s %12s %9s %9s' % (count, method, peak, elapsed, diffs)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit( main(sys.argv[1:]) )
@@ -26,7 +26,7 @@ def unhookfiles():
 	""" 
 		Reverts all the files in the clientspec, but keeps the local data around unchanged
 	"""
-	for entry in p4shelf.p4('opened'):
+	for entry in p4shelf.p4iter('opened'):
 		depotFile = entry['depotFile']
 		logging.debug( 'reverting %s from the client' % (depotFile) )
 		p4shelf.p4( 'revert -k "%s"' % depotFile )
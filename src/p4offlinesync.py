@@ -17,19 +17,26 @@ if "win32" == sys.platform:
 else:
 	FINDCOMMAND = "find . -type f -print"
 
-def doPerforceCommand( command ):
-	""" Returns the error code and entries as a tuple."""
+def iterPerforceCommand( command ):
+	""" 
+		Yields the entries one at a time as perforce produces them. Raises 
+		IOError once the stream ends if the command failed.
+	"""
 	stream = os.popen( command, 'rb' )
-	entries = []
 	try:
 		while True:
-			entry = marshal.load(stream)
-			entries.append(entry)
-	except EOFError:
-		pass
+			try:
+				entry = marshal.load(stream)
+			except EOFError:
+				break
+			yield entry
+	except:
+		stream.close()
+		raise
 	
 	code = stream.close()
-	return code, entries
+	if code:
+		raise IOError( 'Failed to run command "%s"' % command )
 
 def processOutput(results, showDryRun):
 	""" Ignores the info codes and prints only the stat actions."""
@@ -62,9 +69,9 @@ def main( argv ):
 				 FINDCOMMAND + " | p4 -G -x - add %s" ]
 	
 	for i, command in enumerate(commands):
-		code, result = doPerforceCommand( command % dryRunFlag)
-		processOutput(result, len(dryRunFlag) > 0)
-		if code:
+		try:
+			processOutput(iterPerforceCommand(command % dryRunFlag), len(dryRunFlag) > 0)
+		except IOError:
 			print 'Failed to run command "%s"' % (command%dryRunFlag)
 			return i
 
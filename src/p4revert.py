@@ -26,127 +26,528 @@
 
 import os
 import sys
+import string
 import getopt
+import heapq
 import marshal
 import logging
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 P4_PORT_AND_USER = ' '
+JOBS = 4
+BATCH_SIZE = 1000
 
 def p4( command ):
 	"""
 		Run a perforce command line instance and marshal the 
 		result as a list of dictionaries.
 	"""
+	return list(p4iter(command))
+
+def p4iter( command ):
+	"""
+		Same as p4() but yields the dictionaries one at a time as they
+		are unmarshalled. The exit code is checked when the stream ends.
+	"""
 	commandline = 'p4 %s -G %s' % (P4_PORT_AND_USER, command)
 	logging.debug( '%s' % commandline )
 	stream = os.popen( commandline, 'rb' )
-	entries = []
+	count = 0
 	try:
 		while 1:
-			entry = marshal.load(stream)
-			entries.append(entry)
-	except EOFError:
-		pass
+			try:
+				entry = marshal.load(stream)
+			except EOFError:
+				break
+			count += 1
+			yield entry
+	except:
+		stream.close()
+		raise
 	code = stream.close()
 	if None != code:
 		raise IOError( "Failed to execute %s: %d" % (commandline, int(code)) )
-	return entries
+	logging.debug( 'result: %d entries' % count )
+
+def p4batch( command, arguments ):
+	"""
+		Runs one perforce command over a whole list of file arguments
+		by handing them over in an argument file (p4 -x). An empty list
+		doesn't run anything.
+	"""
+	return list(p4batchiter(command, arguments))
 
-def deleteFile(name):
+def p4batchiter( command, arguments ):
 	"""
-		Deletes the file from the repository.
+		Same as p4batch() but streams the dictionaries like p4iter().
 	"""
-	p4( 'delete "%s"' % name )
+	if not len(arguments):
+		return
+	handle, argumentFile = tempfile.mkstemp('.txt', 'p4revert')
+	try:
+		stream = os.fdopen(handle, 'wt')
+		stream.write('\n'.join(arguments) + '\n')
+		stream.close()
+		for result in p4iter( '-x "%s" %s' % (argumentFile, command) ):
+			yield result
+	finally:
+		os.remove(argumentFile)
+
+def isCaseInsensitive():
+	for result in p4( 'info' ):
+		if 'insensitive' == result.get('caseHandling', ''):
+			return True
+	return False
+
+def fileKey():
+	"""
+		The key the server sorts (and matches) depot paths by.
+	"""
+	if isCaseInsensitive():
+		return string.lower
+	return lambda name: name
+
+class RevisionOrderError(ValueError):
+	pass
 
-def backRevision(name, revision, force):
+def sortedFiles( files, key ):
 	"""
-		Given a file and a revision number, tries to go back 
-		one revision in time.
+		Yields (sort key, name, action, revision) from an iterator of
+		(name, action, revision), and raises RevisionOrderError if the
+		names turn out not to be sorted by key.
 	"""
-	targetRevision = revision - 1
-	headAction = p4( 'fstat "%s#%d"' % (name, targetRevision))[0]['headAction']
+	previous = None
+	for name, action, revision in files:
+		k = key(name)
+		if previous is not None and k < previous:
+			raise RevisionOrderError( '%s is out of order' % name )
+		previous = k
+		yield k, name, action, revision
 
-	if 'delete' == headAction:
-		if laterRevisionExists(name, revision) and not force:
-			logging.warn("%s has new edits since this change list was submitted. Skipping automated delete; You must delete manually." % (name))
+def spoolFiles( spec, key ):
+	"""
+		Lists the files for the spec into a temporary file, in key
+		order, and returns it ready for readSpool. Should the server
+		hand them out in some other order, the listing is sorted in
+		memory instead.
+	"""
+	spool = tempfile.TemporaryFile()
+	try:
+		for item in sortedFiles( changelistFiles(spec), key ):
+			marshal.dump( item, spool )
+	except RevisionOrderError, e:
+		logging.debug( 'Listing of %s not sorted (%s), sorting it in memory instead' % (spec, e) )
+		spool.seek(0)
+		spool.truncate()
+		for item in sorted( [(key(name), name, action, revision) for name, action, revision in changelistFiles(spec)] ):
+			marshal.dump( item, spool )
+	spool.seek(0)
+	return spool
+
+def readSpool( spool ):
+	try:
+		while 1:
+			try:
+				item = marshal.load(spool)
+			except EOFError:
+				break
+			yield item
+	finally:
+		spool.close()
+
+def changelistFiles( spec ):
+	"""
+		Streams (name, action, revision) for the revisions "p4 files"
+		lists for the spec, in the order of the files.
+	"""
+	for result in p4iter( 'files %s' % spec ):
+		if 'stat' != result.get('code', 'stat'):
+			continue
+		yield result['depotFile'], result['action'], int(result['rev'])
+
+def changedFiles( first, last, numbers, key ):
+	"""
+		Streams (name, action, revision) for every revision submitted in
+		the changelists first to last, or only the ones in numbers unless
+		it's None. All the revisions of a file come together, in the
+		order of key(name).
+		
+		A range is a single "files -a" over all of it, which the server
+		already sorts by file. A list only asks for the listed
+		changelists, so 12,900000 doesn't scan everything in between.
+		Each "files @=N" is spooled to a temporary file one at a time,
+		so there is only ever one p4 process, and the spools are merged
+		by key.
+	"""
+	if numbers is None:
+		return changelistFiles( '-a "//...@%d,@%d"' % (first, last) )
+	if 1 == len(numbers):
+		return changelistFiles( '"//...@=%d"' % list(numbers)[0] )
+	spools = [spoolFiles( '"//...@=%d"' % number, key ) for number in sorted(numbers)]
+	merged = heapq.merge( *[readSpool(spool) for spool in spools] )
+	return ((name, action, revision) for k, name, action, revision in merged)
+
+def collectRevisions( backs, recovers ):
+	"""
+		One bulk fstat over both the revision before the change and the
+		head revision of the files. Returns three dictionaries keyed by
+		the depot name, the action of the previous revision, the head
+		revision number and the local filename.
+	"""
+	arguments = []
+	for name, revision in backs:
+		arguments.append( '%s#%d' % (name, revision - 1) )
+	for name, revision in backs + recovers:
+		arguments.append( name )
+	previous = {}
+	for name, revision in backs:
+		previous[name] = revision - 1
+	
+	actions = {}
+	heads = {}
+	localNames = {}
+	for result in p4batch( 'fstat', arguments ):
+		if 'stat' != result.get('code', 'stat') or not result.has_key('headRev'):
+			continue
+		name = result['depotFile']
+		headRevision = int(result['headRev'])
+		if previous.get(name) == headRevision:
+			actions[name] = result['headAction']
 		else:
-			deleteFile(name)
-	else:
-		syncDoActionAndResolve(name, "edit", int(revision), force)
+			heads[name] = headRevision
+			localNames[name] = result.get('clientFile', '')
+	return actions, heads, localNames
+
+def netChanges( first, last, numbers ):
+	"""
+		Folds the revisions of the changelists into one entry per file,
+		yields (name, first action, first revision, last action, last
+		revision, number of revisions) one file at a time. Going back to
+		before the first change undoes all of them, and the last change
+		tells what the file looks like now.
+	"""
+	key = fileKey()
+	entry = None
+	for name, action, revision in changedFiles( first, last, numbers, key ):
+		if entry and key(entry[0]) == key(name):
+			if revision < entry[2]:
+				entry[1:3] = [action, revision]
+			elif revision > entry[4]:
+				entry[3:5] = [action, revision]
+			entry[5] += 1
+			continue
+		if entry:
+			yield tuple(entry)
+		entry = [name, action, revision, action, revision, 1]
+	if entry:
+		yield tuple(entry)
+
+def batches( items, size ):
+	"""
+		Groups a stream of items into lists of at most size items.
+	"""
+	batch = []
+	for item in items:
+		batch.append( item )
+		if len(batch) >= size:
+			yield batch
+			batch = []
+	if len(batch):
+		yield batch
 
-def laterRevisionExists(name, revision):
-	headRevision = p4( 'fstat "%s"' % (name))[0]['headRev']
-	return int(headRevision) > revision
+def planRevert( infos, force ):
+	"""
+		Sorts the files into what has to happen to them to go back to
+		before the first change. Returns a tuple of:
+		
+		(files to delete, (file, revision) to edit back, (file, revision) to add back, files to resolve,
+		 dictionary from file to local filename, warnings)
+		
+		A file added by the changes is deleted, a file that is deleted
+		after the changes is added back and everything else is edited
+		back, unless the revision before was a delete. A file with
+		later revisions than the changes is only deleted or resolved
+		when forced, otherwise there is a warning and it is left for a
+		manual resolve. The same goes for a file with revisions in
+		between that are not part of the changes (reverting 12,19 but
+		not 15).
+	"""
+	deletes = []
+	backs = []
+	recovers = []
+	for name, action, revision, lastAction, lastRevision, count in infos:
+		logging.debug( 'Processing %s#%d' % (name, revision) )
+		if 'add' == action or (('branch' == action or 'integrate' == action) and 1 == revision):
+			# Didn't exist before, nothing to do if it doesn't exist any more either.
+			if 'delete' != lastAction:
+				deletes.append( name )
+		elif 'delete' == action and 'delete' == lastAction:
+			recovers.append( (name, revision) )
+		elif action in ('edit', 'delete', 'branch', 'integrate'):
+			backs.append( (name, revision) )
 	
+	actions, heads, localNames = collectRevisions( backs, recovers )
+	revisions = dict(backs + recovers)
+	edits = []
+	adds = []
+	resolves = []
+	warnings = []
+	for name, action, revision, lastAction, lastRevision, count in infos:
+		if not revisions.has_key(name):
+			continue
+		laterRevisionExists = heads[name] > lastRevision or count <= lastRevision - revision
+		if 'delete' == actions.get(name):
+			if 'delete' == lastAction:
+				continue
+			if laterRevisionExists and not force:
+				warnings.append("%s has new edits since this change list was submitted. Skipping automated delete; You must delete manually." % (name))
+			else:
+				deletes.append( name )
+			continue
+		if 'delete' == lastAction:
+			adds.append( (name, revision) )
+		else:
+			edits.append( (name, revision) )
+		logging.debug("revision = %d" % (lastRevision))
+		logging.debug("headRevision = %d" % (heads[name]))
+		if laterRevisionExists and not force:
+			warnings.append("%s has new edits since this change list was submitted. Skipping automated resolve; You must resolve manually." % (name))
+		else:
+			resolves.append( name )
+	return deletes, edits, adds, resolves, localNames, warnings
 
-def recoverFile(name, revision, force):
+def parseChangelists( argument ):
 	"""
-		Adds a deleted file back to the repository.
+		Parses a changelist argument, either a single number, a range
+		(12-19) or a comma separated list (12,15,19). Returns the first
+		and last changelist and the set of changelists in between that
+		count, None for all of them.
 	"""
-	syncDoActionAndResolve(name, "add", int(revision), force)
+	if '-' in argument:
+		first, last = argument.split('-', 1)
+		return int(first), int(last), None
+	numbers = set([int(number) for number in argument.split(',') if len(number.strip())])
+	if not len(numbers):
+		raise ValueError( argument )
+	return min(numbers), max(numbers), numbers
 
-def syncDoActionAndResolve(name, action, revision, force):
-	p4( 'sync "%s#%d"' % (name, revision -1) )
-	p4( '%s "%s"' % (action, name) )
-	p4( 'sync "%s"' % name )
+def clientLineEnd():
+	"""
+		The line ending perforce uses when it writes text files into
+		the client.
+	"""
+	lineEnd = p4( 'client -o' )[0].get('LineEnd', 'local')
+	if 'win' == lineEnd or ('local' == lineEnd and 'nt' == os.name):
+		return '\r\n'
+	if 'mac' == lineEnd:
+		return '\r'
+	return '\n'
 
-	headRevision = int(p4( 'fstat "%s"' % (name))[0]['headRev'])
-	logging.debug("revision = %d" % (revision))
-	logging.debug("headRevision = %d" % (headRevision))
+def fileTypeKind( fileType ):
+	"""
+		Sorts a perforce file type into 'binary' (written as it is),
+		'text' (only the line endings change on the way to the client)
+		or 'other' (unicode, utf8, utf16, symlinks and the like, which
+		only perforce itself knows how to write).
+	"""
+	base = fileType.split('+')[0]
+	if base.endswith('binary'):
+		return 'binary'
+	if base.endswith('text'):
+		return 'text'
+	return 'other'
 
-	if laterRevisionExists(name, revision) and not force:
-		logging.warn("%s has new edits since this change list was submitted. Skipping automated resolve; You must resolve manually." % (name))
-	else:
-		p4( 'resolve -ay "%s"' % name )
+def printRevision( name, revision, localName ):
+	"""
+		Has perforce write the contents of name#revision to the local
+		file itself, with the same translations a sync would do.
+	"""
+	for result in p4( 'print -q -o "%s" "%s#%d"' % (localName, name, revision) ):
+		if 'error' == result.get('code'):
+			raise IOError( result.get('data', '').strip() )
 
+def runPerFile( function, items, jobs ):
+	"""
+		Calls function(*item) for all the items on at most jobs threads,
+		each call is a p4 process of its own so the threads just wait.
+		Returns a list of (item, error message) for the items that
+		failed, in the same order as the items.
+	"""
+	def run( item ):
+		try:
+			function( *item )
+		except (IOError, OSError), e:
+			return str(e)
+		return None
+	if not len(items):
+		return []
+	pool = ThreadPool( max(1, min(jobs, len(items))) )
+	try:
+		errors = pool.map( run, items )
+	finally:
+		pool.close()
+		pool.join()
+	return [(item, error) for item, error in zip(items, errors) if error]
 
-def revertChangelist( changelistNumber, force ):
+def printRevisions( restores, localNames, jobs ):
 	"""
-		Steps through the whole changelist file by file and looks at 
-		the last action taken and then tries to go back one step.
+		Writes the contents of name#revision-1 straight to the local
+		file for all the (name, revision) pairs, with a single "p4 print"
+		over an argument file. Each file is written as its data streams
+		in. Returns a list of ((name, revision - 1, local filename),
+		error message) for the files that didn't get written, in the
+		same order as the restores.
+		
+		The print data is the server's form of the file, so text files
+		get the client's line endings here. Types that need a charset
+		translation are printed afterwards with a "print -o" each, on
+		at most jobs threads.
 	"""
-	logging.debug( 'Trying to revert the changelist %d' % changelistNumber )
-	description = p4( 'describe -s %d' % changelistNumber )[0]
-	infos = []
-	counter = 0
+	arguments = ['%s#%d' % (name, revision - 1) for name, revision in restores]
+	lineEnd = clientLineEnd()
+	written = {}
+	errors = []
+	others = []
+	target = None
+	translate = False
 	try:
-		while 1:
-			name = description[ 'depotFile%d' % counter ]
-			action = description[ 'action%d' % counter ]
-			revision = int(description[ 'rev%d' % counter ])
-			infos.append( (name, action, revision) )
-			counter += 1
-	except KeyError:
-		pass
+		for result in p4batchiter( 'print', arguments ):
+			code = result.get('code', '')
+			if 'stat' == code:
+				if target:
+					target.close()
+					target = None
+				name = result['depotFile']
+				localName = localNames[name]
+				try:
+					localDir = os.path.dirname(localName)
+					if len(localDir) and not os.path.isdir(localDir):
+						os.makedirs(localDir)
+				except OSError:
+					pass # Opening the file below tells what went wrong.
+				kind = fileTypeKind( result.get('type', 'binary') )
+				if 'other' == kind:
+					others.append( (name, int(result['rev']), localName) )
+					continue
+				try:
+					target = open(localName, 'wb')
+					written[name] = 1
+				except IOError, e:
+					errors.append( '%s#%s - %s' % (name, result.get('rev', ''), e) )
+				translate = 'text' == kind and '\n' != lineEnd
+			elif 'error' == code:
+				errors.append( result.get('data', '').strip() )
+			elif target and result.has_key('data'):
+				if translate:
+					target.write(result['data'].replace('\n', lineEnd))
+				else:
+					target.write(result['data'])
+	finally:
+		if target:
+			target.close()
 	
-	for name, action, revision in infos:
-		logging.debug( 'Processing %s#%d' % (name, revision) )
-		if 'add' == action:
-			deleteFile(name)
-		if 'edit' == action:
-			backRevision(name, revision, force)
-		if 'delete' == action:
-			recoverFile(name, revision, force)
-		if 'branch' == action or 'integrate' == action:
-			if 1 == revision:
-				deleteFile(name)
-			else:
-				backRevision(name, revision, force)
+	otherErrors = {}
+	for (name, revision, localName), error in runPerFile( printRevision, others, jobs ):
+		otherErrors[name] = error
+	for name, revision, localName in others:
+		if not otherErrors.has_key(name):
+			written[name] = 1
+	
+	failures = []
+	for (name, revision), argument in zip(restores, arguments):
+		if written.has_key(name):
+			continue
+		error = otherErrors.get(name, 'nothing was printed')
+		for message in errors:
+			if message.startswith(argument) or message.startswith(name + '#'):
+				error = message
+				break
+		failures.append( ((name, revision - 1, localNames[name]), error) )
+	return failures
+
+def revertChangelists( first, last, numbers, force, singleTransfer, jobs ):
+	"""
+		Reverts the changelists by working out where each file has to
+		go back to, so a file touched by several of them still only
+		gets one operation. The files stream in from the server and are
+		reverted BATCH_SIZE at a time, so the memory use doesn't depend
+		on the size of the changelists. Warnings and failures are
+		reported at the end in the order of the files, and the number of
+		failures is returned.
+	"""
+	logging.debug( 'Trying to revert the changelists %d to %d' % (first, last) )
+	warnings = []
+	failures = []
+	for infos in batches( netChanges(first, last, numbers), BATCH_SIZE ):
+		revertFiles( infos, force, singleTransfer, jobs, warnings, failures )
 	
+	for warning in warnings:
+		logging.warn( warning )
+	for (name, revision, localName), error in failures:
+		logging.error( 'Failed to restore %s#%d: %s' % (name, revision, error) )
+	return len(failures)
+
+def revertFiles( infos, force, singleTransfer, jobs, warnings, failures ):
+	"""
+		Reverts a batch of files from netChanges. All the files are
+		planned up front and every step then runs as one batch:
+		
+		sync #rev-1, edit/add, sync to head, resolve -ay, delete
+		
+		With singleTransfer the syncs only move the have list (sync -k)
+		and the old contents are printed straight into the local files,
+		so every file crosses the wire once instead of twice:
+		
+		sync -k #rev-1, edit, print #rev-1, add, sync -k to head, resolve -ay, delete
+		
+		All the old revisions come from a single print, except for the
+		types only perforce can write, which get a print each on up to
+		jobs threads. A file that fails to print isn't added or
+		resolved. The warnings and failures are added to the given
+		lists.
+	"""
+	deletes, edits, recovers, resolves, localNames, batchWarnings = planRevert( infos, force )
+	warnings += batchWarnings
+	
+	restores = edits + recovers
+	if singleTransfer:
+		p4batch( 'sync -k', ['%s#%d' % (name, revision - 1) for name, revision in restores] )
+		p4batch( 'edit', [name for name, revision in edits] )
+		batchFailures = printRevisions( restores, localNames, jobs )
+		failures += batchFailures
+		failed = dict([(item[0], 1) for item, error in batchFailures])
+		recovers = [(name, revision) for name, revision in recovers if not failed.has_key(name)]
+		resolves = [name for name in resolves if not failed.has_key(name)]
+		p4batch( 'add', [name for name, revision in recovers] )
+		p4batch( 'sync -k', [name for name, revision in restores] )
+	else:
+		p4batch( 'sync', ['%s#%d' % (name, revision - 1) for name, revision in restores] )
+		p4batch( 'edit', [name for name, revision in edits] )
+		p4batch( 'add', [name for name, revision in recovers] )
+		p4batch( 'sync', [name for name, revision in restores] )
+	p4batch( 'resolve -ay', resolves )
+	p4batch( 'delete', deletes )
 
 def main(argv):
 	"""
 		Usage: p4revert.py [options] <changelist>
+		       p4revert.py [options] <first changelist>-<last changelist>
+		       p4revert.py [options] <changelist>,<changelist>,...
 
 			Options:
 				-v              : verbose
 				-f              : force
+				-j jobs         : run at most this many per file p4 commands at once (default 4)
+				-k              : transfer each file only once, sync -k and print the old
+				                  revision instead of syncing back and forth (servers from
+				                  2016.2 can also do this with "p4 undo")
 				-c client       : perforce client
 				-p port         : perforce port
 				-u user         : perforce user
 	"""
 	try:
-		options, arguments = getopt.getopt(argv, 'c:p:u:vf')
+		options, arguments = getopt.getopt(argv, 'c:p:u:j:vfk')
 	except getopt.GetoptError:
 		print 'Error parsing arguments'
 		print main.__doc__
@@ -155,6 +556,8 @@ def main(argv):
 	# Default tweakable values for the options.
 	verbose = False
 	force = False
+	singleTransfer = False
+	jobs = JOBS
 	client = ''
 	port = ''
 	user = ''
@@ -171,18 +574,29 @@ def main(argv):
 			user = a
 		if '-f' == o:
 			force = True
+		if '-k' == o:
+			singleTransfer = True
+		if '-j' == o:
+			try:
+				jobs = max(1, int(a))
+			except ValueError:
+				print 'The number of jobs must be a number!'
+				print main.__doc__
+				return 1
 	
 	if len(arguments) != 1:
 		print 'Must give one changelist number'
 		print main.__doc__
 		return 1
 	
-	try:
-		changelistNumber = int(arguments[0])
-	except ValueError:
-		print 'Changelist number must be a number!'
-		print main.__doc__
-		return 1
+	# Logging goes first so that nothing that talks to perforce can run before it.
+	if verbose:
+		logging.basicConfig( 
+			level=logging.DEBUG, 
+			format='%(asctime)s %(levelname)-7s: %(message)s' )
+	else:
+		logging.basicConfig( 
+			level=logging.INFO, format='%(message)s' )
 	
 	global P4_PORT_AND_USER
 	if len(client):
@@ -192,25 +606,23 @@ def main(argv):
 	if len(user):
 		P4_PORT_AND_USER += ' -u %s ' % user
 	
+	try:
+		first, last, numbers = parseChangelists(arguments[0])
+	except ValueError:
+		print 'Changelist number must be a number!'
+		print main.__doc__
+		return 1
+	
 	# At this point we're all done with the options! Now to the real code.
-	if verbose:
-		logging.basicConfig( 
-			level=logging.DEBUG, 
-			format='%(asctime)s %(levelname)-7s: %(message)s' )
-	else:
-		logging.basicConfig( 
-			level=logging.INFO, format='%(message)s' )
-
-	revertChangelist( changelistNumber, force )
-	logging.info( 'Revert of %d done.' % changelistNumber )
-	results = p4 ( "resolve -n" )
-	for result in results:
+	failures = revertChangelists( first, last, numbers, force, singleTransfer, jobs )
+	logging.info( 'Revert of %s done.' % arguments[0] )
+	for result in p4iter( "resolve -n" ):
 		code = result['code']
 		if code == 'stat':
 			logging.warning("%s must be resolved." % (result['fromFile']))
 		elif code == 'error':
 			logging.info("Change list reverted and files are ready for submit.")
-	return 0
+	return int(failures > 0)
 	
 if __name__ == '__main__':
 	# This is just the main stub trick that makes the script act like a regular
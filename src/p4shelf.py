@@ -22,19 +22,62 @@ import time
 import zipfile
 import string
 import re
+import tempfile
+import zlib
+import shutil
+import collections
+import hashlib
+import json
+import sqlite3
+import difflib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 VERBOSE = 0
 FAKEIT  = 1
 DESCRIPTION_FILENAME = '___p4shelf_information___.txt'
+SYNCSTATE_FILENAME = '___p4shelf_syncstate___.txt'
+MANIFEST_FORMAT = 'p4shelf-manifest'
+MANIFEST_VERSION = 4
+# Perforce hands us raw bytes in whatever code page the client used. Going through latin-1 maps every
+# byte to exactly one character, so any path or comment survives the trip through json unchanged.
+MANIFEST_ENCODING = 'latin-1'
+
+# Per extension compression for the zip members, either 'store' or a deflate level. Everything
+# else gets picked by how well a quick deflate shrinks the first block of the file.
+CODECS = {
+	'.zip' : 'store', '.7z'  : 'store', '.gz'  : 'store', '.bz2' : 'store', '.rar' : 'store',
+	'.png' : 'store', '.jpg' : 'store', '.jpeg': 'store', '.gif' : 'store',
+	'.mp3' : 'store', '.mp4' : 'store', '.ogg' : 'store', '.avi' : 'store',
+}
 COMMON_FLAGS = ''
+CLIENT_NAMES = {}
+SERVER_INFO = {}
+CLIENT_SPECS = {}
 
 VERSION = 'v0.2'
 MAX_CHANGELIST_DESC = 64
+COMPRESS_CHUNK = 1024 * 1024
+SPOOL_SIZE = 4 * 1024 * 1024
+CODEC_SAMPLE = 16 * 1024
+STORE_HEADER = 'P4SHELF-STORE: 1'
+STORE_EXTENSION = '.p4m'
+STORE_OBJECTS = 'objects'
+VERIFY_CHUNK = 64 * 1024 * 1024
+VERIFY_MEMBERS = 256
+DIGEST_CACHE = os.path.join(os.path.expanduser('~'), '.p4shelf_digests')
 HELP = """
 
 p4shelf %s (c) 2008 Jim Tilander. A tool to ease the minds of paranoid programmers.
 
 Usage: p4shelf [options] <filename>
+       p4shelf --gc [-y] <store directory>
+       p4shelf --catalog=<db> <archive directory>
+       p4shelf --catalog=<db> --find=<depot path or pattern>
+       p4shelf --diff [--content] <filename> [<other filename>]
+       p4shelf --verify [--workers=<n>] <filename>...
+       p4shelf --raw=<directory> [-y] [--workers=<n>] <filename>
 
 Valid options:
     -c <client>     : perforce client spec
@@ -46,12 +89,45 @@ Valid options:
     -h              : help
     -y              : actually do work (default is to show only)
     -m              : set comment
-    -s <changelist> : only archive specified changelist
+    -s <changelist> : only archive specified changelist. Give "all" or a comma separated list (-s 12,34) to
+                      write one archive per changelist in a single run (create only), the changelist
+                      number (or "default") is added to each filename
     -f              : use exact filename for compression
     -d              : open head revision and ignore the source revision for extract operations
     -o              : overwrite target file, always
     -r              : use client relative paths instead of depot absolute paths (useful for moving files from different clients)
     --archive-desc  : add some of the changelist description to the archive name (create only)
+    --workers=<n>   : how much work runs in parallel, default is one per cpu. Threads compressing files when
+                      creating, processes checking archives for --verify, threads writing files for --raw
+    --sync-state    : create: also record how the have list differs from the last synced changelist
+                      extract: sync the client back to exactly that state before restoring files
+    --resume        : continue an interrupted extract in the changelist it created, skipping the work that
+                      the journal (<filename>.journal) says is already done (extract only)
+    --backend=<name>: where the file contents go when creating, "zip" (default) stores them in the archive,
+                      "server" shelves them on the server (needs a 2009.2 server) and only keeps the metadata
+                      in the archive, "auto" uses server when the server can shelve and zip otherwise.
+                      Every archive gets a new pending changelist of its own holding the shelved files, so
+                      the opened changelist can still be submitted. The shelf changelist stays around as
+                      long as the archive is needed, remove it with "p4 shelve -d -c N" and "p4 change -d N"
+    --codec=<ext>:<codec> : how to compress files with the extension, codec is "store" or a deflate
+                      level 1-9 (create only, can be repeated). Other files are picked by how well they compress
+    --store         : create a small manifest (.p4m) instead of a zip, the file contents go into a shared
+                      content addressed object directory next to it, so unchanged files are only stored once
+    --gc            : remove objects from a store directory that no manifest refers to any more
+    --catalog=<db>  : update the sqlite catalog of all the archives under the directory, only archives
+                      that are new or changed since the last update are read
+    --find=<path>   : list the archives in the catalog that have the file, "..." and "*" match anything
+    --diff          : show which files of the shelf are identical, modified, missing or extra compared to
+                      the client (asks perforce for the client view and the opened files), or to another
+                      shelf when two filenames are given (never asks perforce). Files whose contents are
+                      not in the archive (--skip-unchanged, --backend=server) are reported as unverified
+    --content       : also show a unified diff of the modified files (diff only)
+    --verify        : check that the manifest matches the archive and that every file in it decompresses
+                      with the right CRC, without writing anything. Prints a JSON report per archive
+    --raw=<dir>     : just write the files of the shelf under the directory by their client relative names,
+                      without perforce or a client (deleted files are left out)
+    --skip-unchanged: don't store the contents of files opened for edit that are identical to the
+                      revision they were opened at, extract just opens them for edit again (create only)
 """ % VERSION
 
 def p4(command):
@@ -59,22 +135,60 @@ def p4(command):
 		The heart of the script, this executes any perforce command and then returns the results as
 		a list of dictionaries of the result.
 	"""
+	return list(p4iter(command))
+
+def p4iter(command):
+	"""
+		Streaming version of p4(). Yields the dictionaries one by one as they are unmarshalled from
+		perforce, so that huge listings never have to fit in memory at once. The exit code is 
+		checked when the stream runs dry, so a failure surfaces after the last entry.
+	"""
 	commonFlags = COMMON_FLAGS
 	commandline = 'p4 %s -G %s' % (commonFlags, command)
 	logging.debug( '%s' % commandline )
 	stream = os.popen( commandline, 'rb' )
-	entries = []
+	count = 0
 	try:
 		while 1:
-			entry = marshal.load(stream )
-			entries.append(entry)
-	except EOFError:
-		pass
-	code = stream .close()
+			try:
+				entry = marshal.load(stream)
+			except EOFError:
+				break
+			count += 1
+			yield entry
+	except:
+		# The caller stopped early (or blew up), just get rid of the process.
+		stream.close()
+		raise
+	code = stream.close()
 	if None != code:
 		raise IOError( "Failed to execute %s: %d" % (commandline, int(code)) )
-	logging.debug( 'result: %s' % (str(entries)) )
-	return entries
+	logging.debug( 'result: %d entries' % count )
+
+def p4batch(command, arguments):
+	"""
+		Runs a single perforce command over a whole list of file arguments by handing them
+		to perforce through an argument file (p4 -x). Returns the results as a list of 
+		dictionaries, just like p4(). An empty list of arguments doesn't spawn anything.
+	"""
+	return list(p4batchiter(command, arguments))
+
+def p4batchiter(command, arguments):
+	"""
+		Streaming version of p4batch(), see p4iter().
+	"""
+	if not len(arguments):
+		return
+	handle, argumentFile = tempfile.mkstemp('.txt', 'p4shelf')
+	try:
+		stream = os.fdopen(handle, 'wt')
+		stream.write('\n'.join(arguments) + '\n')
+		stream.close()
+		logging.debug( 'Running %s over %d arguments' % (command, len(arguments)) )
+		for entry in p4iter( '-x "%s" %s' % (argumentFile, command) ):
+			yield entry
+	finally:
+		os.remove(argumentFile)
 
 def p4raw(command, input=''):
 	"""
@@ -92,12 +206,15 @@ def p4raw(command, input=''):
 		raise IOError("Failed to execute %s: %d \n%s" % (commandline, int(code), output) )
 	return output
 
-def createChangelist(description):
+def createChangelist(description, takeDefaultFiles=1):
 	"""
-		Creates a new changelist and returns the number.
+		Creates a new changelist and returns the number. Perforce moves the files of the default
+		changelist into it unless takeDefaultFiles is false.
 	"""
 	logging.debug('Creating new changelist with description %s' % description)
 	form = p4raw('change -o')
+	if not takeDefaultFiles:
+		form = re.sub(r'\nFiles:.*', '\n', form, flags=re.S)
 	description = description.replace('\n', '\n\t')
 	form = form.replace('<enter description here>', description + '\n\n')
 	result = p4raw('change -i', form)
@@ -111,8 +228,38 @@ def getClientName():
 	"""
 		Tries to figure out the current clientname. If it was given on the command line, it
 		will be returned here, but the fallback will be fixed by perforce.
+		
+		The answer is remembered for the current set of common flags, so that asking again
+		doesn't cost another round trip to the server.
 	"""
+	try:
+		return CLIENT_NAMES[COMMON_FLAGS]
+	except KeyError:
+		pass
+	clientname = queryClientName()
+	CLIENT_NAMES[COMMON_FLAGS] = clientname
+	return clientname
+
+def serverInfo():
+	"""
+		Returns the result of "p4 info", remembered for the current set of common flags.
+	"""
+	try:
+		return SERVER_INFO[COMMON_FLAGS]
+	except KeyError:
+		pass
 	entries = p4( 'info' )
+	SERVER_INFO[COMMON_FLAGS] = entries
+	return entries
+
+def isCaseInsensitive():
+	for entry in serverInfo():
+		if 'insensitive' == entry.get('caseHandling', ''):
+			return 1
+	return 0
+
+def queryClientName():
+	entries = serverInfo()
 	try:
 		return entries[0]['clientName'].strip()
 	except KeyError:
@@ -151,6 +298,52 @@ def calcRevisionDiff(changefiles, havefiles):
 	
 	return diffs
 
+class RevisionOrderError(ValueError):
+	pass
+
+def sortedRevisions(files, key):
+	"""
+		Yields (sort key, name, revision) from an iterator of (name, revision), and raises 
+		RevisionOrderError if the names turn out not to be sorted.
+	"""
+	previous = None
+	for name, rev in files:
+		k = key(name)
+		if previous is not None and k <= previous:
+			raise RevisionOrderError( '%s is out of order' % name )
+		previous = k
+		yield k, name, rev
+
+def mergeRevisionDiff(changefiles, havefiles, key=lambda name: name):
+	"""
+		Gives the same differences as calcRevisionDiff, but walks the two listings side by side
+		as a sorted merge join. Both have to be sorted by key(name), which is how the server 
+		hands them out. Nothing but the current entry of each listing is held in memory, so 
+		this is a generator that yields the differences as (name, revision).
+	"""
+	changes = sortedRevisions(changefiles, key)
+	haves = sortedRevisions(havefiles, key)
+	change = next(changes, None)
+	have = next(haves, None)
+	while change is not None or have is not None:
+		if have is None or (change is not None and change[0] < have[0]):
+			# Was part of the changelist, but we don't have it at all.
+			yield (change[1], 0)
+			change = next(changes, None)
+		elif change is None or have[0] < change[0]:
+			# We have something that wasn't part of the changelist.
+			yield (have[1], have[2])
+			have = next(haves, None)
+		else:
+			if change[2] != have[2]:
+				yield (have[1], have[2])
+			change = next(changes, None)
+			have = next(haves, None)
+
+def listRevisions(command):
+	for x in p4iter(command):
+		yield x['depotFile'], int(x['rev'])
+
 def findFileRevisions():
 	clientname = getClientName()
 	logging.debug( 'Searching for the files on the client "%s"' % clientname )
@@ -158,22 +351,68 @@ def findFileRevisions():
 	lastchange = int(p4( 'changes -m 1 //%s/...#have' % clientname )[0]['change'])
 	logging.debug( 'Last synced changelist was #%d' % lastchange )
 	
-	logging.debug( 'Listing file revisions from changelist #%d' % lastchange )
-	changefiles = [ (x['depotFile'], int(x['rev'])) for x in p4('files //%s/...@%d' % (clientname,lastchange)) ]
+	changeCommand = 'files //%s/...@%d' % (clientname,lastchange)
+	haveCommand = 'files //%s/...#have' % clientname
 	
-	logging.debug( 'Listing file revisions on actual client' )
-	havefiles = [ (x['depotFile'], int(x['rev'])) for x in p4('files //%s/...#have' % clientname) ]
-	
-	revdiffs = calcRevisionDiff(changefiles, havefiles)
+	# Stream both listings through a merge join, this keeps the memory use flat no matter how
+	# many files the client has. 
+	key = lambda name: name
+	if isCaseInsensitive():
+		key = string.lower
+	logging.debug( 'Comparing file revisions from changelist #%d with the ones on the actual client' % lastchange )
+	try:
+		revdiffs = list( mergeRevisionDiff(listRevisions(changeCommand), listRevisions(haveCommand), key) )
+	except RevisionOrderError, e:
+		# Should the server ever hand things out in an order we don't expect, we just fall back 
+		# to doing it all in memory.
+		logging.debug( 'Listing not sorted (%s), comparing in memory instead' % e )
+		changefiles = list(listRevisions(changeCommand))
+		havefiles = list(listRevisions(haveCommand))
+		revdiffs = calcRevisionDiff(changefiles, havefiles)
+	return lastchange, revdiffs
+
+def writeSyncState(lastchange, revdiffs):
+	"""
+		Serializes the result of findFileRevisions, the last synced changelist followed by one
+		"revision depotname" line for every file that differs from it (revision 0 means that we
+		don't have the file at all).
+	"""
+	lines = [ 'CHANGE: %d' % lastchange ]
+	for name, rev in revdiffs:
+		lines.append( '%d %s' % (rev, name) )
+	return '\n'.join(lines) + '\n'
+
+def readSyncState(data):
+	lines = filter( len, data.split('\n') )
+	lastchange = int( re.match('^CHANGE: (\d+)', lines[0]).group(1) )
+	revdiffs = []
+	for line in lines[1:]:
+		rev, name = line.split(' ', 1)
+		revdiffs.append( (name, int(rev)) )
 	return lastchange, revdiffs
 
+def planSyncState(lastchange, revdiffs):
+	"""
+		Plan steps (see planExtract) that put the client back into the recorded state, first
+		everything to the last synced changelist and then all the odd revisions in one go.
+	"""
+	exceptions = []
+	for name, rev in revdiffs:
+		if rev:
+			exceptions.append( '%s#%d' % (name, rev) )
+		else:
+			exceptions.append( '%s#none' % name )
+	return [ ('sync', ['//%s/...@%d' % (getClientName(), lastchange)]),
+			 ('sync', exceptions) ]
+
 def collectOpenedFiles(changelist, useClientRelativePaths):
 	"""
 		Returns a list of all the opened files. Each entry in the list is a tuple of
 		
-		(filename, base revision, what we did in perforce)
+		(filename, base revision, what we did in perforce, depot filename)
 		
 		This tuple is then stored into the metadata and later acted upon when we estract things.
+		The depot filename is always in depot syntax, so that we can join it against fstat.
 	"""
 	result = []
 	
@@ -181,17 +420,106 @@ def collectOpenedFiles(changelist, useClientRelativePaths):
 	if 0 != changelist:
 		changestring = ' -c %d ' % changelist
 	
-	for entry in p4( 'opened %s' % changestring ):
-		if useClientRelativePaths:
-			filename = entry['clientFile']
-		else:
-			filename = entry['depotFile']
-		result.append( (filename, int(entry['rev']), entry['action']) )
+	for entry in p4iter( 'opened %s' % changestring ):
+		result.append( openedFileEntry(entry, useClientRelativePaths) )
+	return result
+
+def openedFileEntry(entry, useClientRelativePaths):
+	if useClientRelativePaths:
+		filename = entry['clientFile']
+	else:
+		filename = entry['depotFile']
+	return (filename, int(entry['rev']), entry['action'], entry['depotFile'])
+
+def collectOpenedChangelists(useClientRelativePaths):
+	"""
+		Same as collectOpenedFiles, but for every changelist at once from a single "opened" call.
+		Returns a dictionary from changelist number (0 for the default changelist) to the list
+		of opened files in it.
+	"""
+	result = {}
+	for entry in p4iter( 'opened' ):
+		change = entry.get('change', 'default')
+		if 'default' == change:
+			change = 0
+		result.setdefault(int(change), []).append( openedFileEntry(entry, useClientRelativePaths) )
+	return result
+
+def pendingDescriptions():
+	"""
+		Returns a dictionary from pending changelist number to its description, for all the
+		pending changelists of this client in one call.
+	"""
+	result = {}
+	for entry in p4iter( 'changes -l -s pending -c %s' % getClientName() ):
+		result[int(entry['change'])] = entry.get('desc', '').rstrip()
 	return result
 
-def depotNameToLocal( depotname ):
-	results = p4( 'fstat "%s"' % depotname )
-	return results[0]['clientFile']
+def md5File(filename):
+	hasher = hashlib.md5()
+	for chunk in readChunks(filename):
+		hasher.update(chunk)
+	return hasher.hexdigest().upper()
+
+def findUnchangedFiles(changedfiles, metadata, workers):
+	"""
+		Figures out which of the files opened for edit are still identical to the revision they
+		were opened at. All the depot digests come from one bulk "fstat -Ol", the local md5s are
+		calculated on a pool of threads (and only for files where the size matches).
+		
+		Returns a dictionary keyed by depot filename.
+	"""
+	candidates = []
+	for name, revision, action, depotName in changedfiles:
+		if 'edit' == action and not len(sourceDepotName(metadata[depotName])):
+			candidates.append( '%s#%d' % (depotName, revision) )
+	
+	digests = {}
+	for entry in p4batchiter( 'fstat -Ol', candidates ):
+		try:
+			digests[entry['depotFile']] = (entry['digest'], int(entry['fileSize']))
+		except KeyError:
+			pass
+	
+	def isUnchanged(depotName):
+		digest, size = digests[depotName]
+		localName = metadata[depotName]['clientFile']
+		try:
+			if os.path.getsize(localName) != size:
+				return 0
+			return md5File(localName) == digest
+		except (OSError, IOError):
+			return 0
+	
+	depotNames = digests.keys()
+	pool = ThreadPool(workers)
+	try:
+		results = pool.map(isUnchanged, depotNames)
+	finally:
+		pool.terminate()
+	
+	unchangedFiles = {}
+	for depotName, unchanged in zip(depotNames, results):
+		if unchanged:
+			logging.debug( '%s is identical to the base revision' % depotName )
+			unchangedFiles[depotName] = 1
+	logging.info( '%d of %d files opened for edit are unchanged' % (len(unchangedFiles), len(candidates)) )
+	return unchangedFiles
+
+def collectFileMetadata(depotNames):
+	"""
+		Runs one bulk "fstat -Or" over all the given depot files and returns a dictionary
+		from depot filename to the fstat result. This replaces asking the server once per
+		file for both the local name and the integration source.
+	"""
+	metadata = {}
+	for entry in p4batchiter( 'fstat -Or', depotNames ):
+		if 'stat' != entry.get('code', 'stat'):
+			logging.warning( 'fstat: %s' % entry.get('data', str(entry)).strip() )
+			continue
+		metadata[entry['depotFile']] = entry
+	logging.debug( 'Collected metadata for %d files' % len(metadata) )
+	return metadata
 
 def depotWhere( depotname ):
 	result = p4( 'where "%s"' % depotname )[0]
@@ -210,14 +538,12 @@ def toClientRelative( sourceClientName, depotname ):
 	result = re.sub( '//%s/' % sourceClientName, '//%s/' % myClientName, depotname )
 	return result
 	
-def findSourceDepotName( depotName ):
+def sourceDepotName( result ):
 	"""
 		In the case when we've integrated a file the data could have come from potentially any file
-		in the source tree. This should give us the full depot path of the file we integrated from,
-		and into the "depotName" (which should be opened for edit/integrate at this point).
+		in the source tree. This picks the full depot path of the file we integrated from out of an
+		already fetched "fstat -Or" result of the target.
 	"""
-	result = p4( 'fstat -Or "%s"' % depotName )[0]
-	
 	try:
 		sourceName = result['resolveBaseFile0']
 		sourceRev = int(result['resolveBaseRev0'])
@@ -229,11 +555,220 @@ def findSourceDepotName( depotName ):
 	except KeyError:
 		return ''
 	
+def clientSpec():
+	"""
+		Returns the result of "p4 client -o", remembered for the current set of common flags.
+	"""
+	try:
+		return CLIENT_SPECS[COMMON_FLAGS]
+	except KeyError:
+		pass
+	spec = p4( 'client -o' )[0]
+	CLIENT_SPECS[COMMON_FLAGS] = spec
+	return spec
+
+def clientLineEnd():
+	"""
+		The line ending perforce uses when it writes text files into this client.
+	"""
+	lineEnd = clientSpec().get('LineEnd', 'local')
+	if 'win' == lineEnd or ('local' == lineEnd and 'nt' == os.name):
+		return '\r\n'
+	if 'mac' == lineEnd:
+		return '\r'
+	return '\n'
+
+def fileTypeKind(fileType):
+	"""
+		Sorts a perforce file type into 'binary' (the bytes go to disk as they are), 'text' (only
+		the line endings change on the way to the client) or 'other' (unicode, utf8, utf16,
+		symlinks and the like, where only perforce itself knows how to write the file).
+	"""
+	base = fileType.split('+')[0]
+	if base.endswith('binary'):
+		return 'binary'
+	if base.endswith('text'):
+		return 'text'
+	return 'other'
+
 def clientRoot():
-	client = getClientName()
-	return p4( 'client -o' )[0]['Root'].strip()
+	return clientSpec()['Root'].strip()
 
-def createFilename(filename, comment):
+class ClientView:
+	"""
+		An in-process copy of the client's view mapping, so that translating a depot path into
+		a local path doesn't cost a "p4 where" round trip per file. Follows the perforce rules:
+		
+		- later lines override earlier ones, both on the depot and on the client side
+		- lines starting with "-" exclude files
+		- lines starting with "+" overlay, they don't hide earlier lines mapping the same client file
+		- "..." matches anything, "*" anything within a directory, %%1-%%9 are positional "*"
+	"""
+	def __init__(self, clientName, root, viewLines, ignoreCase=0):
+		self.clientName = clientName
+		self.root = root
+		self.ignoreCase = ignoreCase
+		self.mappings = []
+		for line in viewLines:
+			mapping = parseViewLine(line, ignoreCase)
+			if mapping:
+				self.mappings.append(mapping)
+	
+	def clientPath(self, depotPath):
+		"""
+			Translates a depot path into client syntax (//client/...), returns None if the file
+			isn't mapped into the client.
+		"""
+		if self.isClientSyntax(depotPath):
+			return depotPath
+		count = len(self.mappings)
+		for i in range(count - 1, -1, -1):
+			kind, depotRe, depotKeys, depotParts, clientRe, clientKeys, clientParts = self.mappings[i]
+			m = depotRe.match(depotPath)
+			if not m:
+				continue
+			if '-' == kind:
+				return None
+			values = {}
+			for key, value in zip(depotKeys, m.groups()):
+				values[key] = value
+			clientPath = substituteViewPattern(clientParts, values)
+			# A later line that claims the same client file hides this one, unless it's an overlay.
+			for j in range(i + 1, count):
+				if '+' != self.mappings[j][0] and self.mappings[j][4].match(clientPath):
+					return None
+			return clientPath
+		return None
+	
+	def depotPaths(self, clientPath):
+		"""
+			Translates a client path back into the depot files that can end up there, the one
+			that wins first. Only overlay lines give more than one: the file comes from the
+			latest overlay line whose depot file exists.
+		"""
+		result = []
+		for i in range(len(self.mappings) - 1, -1, -1):
+			kind, depotRe, depotKeys, depotParts, clientRe, clientKeys, clientParts = self.mappings[i]
+			m = clientRe.match(clientPath)
+			if not m:
+				continue
+			if '-' == kind:
+				break
+			values = {}
+			for key, value in zip(clientKeys, m.groups()):
+				values[key] = value
+			depotPath = substituteViewPattern(depotParts, values)
+			# A later line can still exclude the depot file or send it somewhere else.
+			if self.clientPath(depotPath) == clientPath:
+				result.append(depotPath)
+			if '+' != kind:
+				break
+		return result
+	
+	def localPath(self, depotPath):
+		"""
+			Translates a depot path into a local filename, returns None if the file isn't mapped
+			or if the client has no root.
+		"""
+		clientPath = self.clientPath(depotPath)
+		if not clientPath or not len(self.root) or 'null' == self.root:
+			return None
+		relative = clientPath[len(self.clientName) + 3:]
+		for escaped, character in [('%40', '@'), ('%23', '#'), ('%2A', '*'), ('%25', '%')]:
+			relative = relative.replace(escaped, character)
+		return os.path.join(self.root, relative.replace('/', os.sep))
+	
+	def isClientSyntax(self, path):
+		prefix = '//%s/' % self.clientName
+		if self.ignoreCase:
+			return path[:len(prefix)].lower() == prefix.lower()
+		return path.startswith(prefix)
+
+def parseViewLine(line, ignoreCase):
+	"""
+		Splits one line of a client view into a compiled mapping tuple of
+		
+		(kind, depot regexp, depot wildcard keys, depot pattern parts,
+		 client regexp, client wildcard keys, client pattern parts)
+		
+		where kind is '', '-' or '+'. Returns None for lines we don't understand.
+	"""
+	tokens = re.findall( r'[-+]?"[^"]*"|[^\s"]+', line )
+	if len(tokens) != 2:
+		logging.warning( 'Ignoring view line %s' % line )
+		return None
+	kind = ''
+	sides = []
+	for token in tokens:
+		prefix = ''
+		if token[0] in '-+':
+			prefix, token = token[0], token[1:]
+		token = token.strip('"')
+		if token[:1] in ['-', '+']:
+			prefix, token = token[0], token[1:]
+		if len(prefix) and not len(sides):
+			kind = prefix
+		sides.append(token)
+	
+	depotRe, depotKeys, depotParts = compileViewPattern(sides[0], ignoreCase)
+	clientRe, clientKeys, clientParts = compileViewPattern(sides[1], ignoreCase)
+	return kind, depotRe, depotKeys, depotParts, clientRe, clientKeys, clientParts
+
+def compileViewPattern(pattern, ignoreCase):
+	"""
+		Compiles one side of a view line into a regexp. Returns the regexp, the wildcard keys in
+		the order of the regexp groups and the pattern split into literals and wildcards. Wildcards
+		are paired up between the two sides by their type and position, or by number for %%n.
+	"""
+	parts = re.split( r'(\.\.\.|\*|%%[1-9])', pattern )
+	expression = ''
+	keys = []
+	counts = {'...': 0, '*': 0}
+	for i in range(len(parts)):
+		part = parts[i]
+		if i % 2 == 0:
+			expression += re.escape(part)
+			continue
+		if '...' == part:
+			expression += '(.*)'
+		else:
+			expression += '([^/]*)'
+		if part.startswith('%%'):
+			key = part
+		else:
+			key = (part, counts[part])
+			counts[part] += 1
+		keys.append(key)
+		parts[i] = key
+	flags = 0
+	if ignoreCase:
+		flags = re.IGNORECASE
+	return re.compile('^' + expression + '$', flags), keys, parts
+
+def substituteViewPattern(parts, values):
+	result = ''
+	for i in range(len(parts)):
+		if i % 2 == 0:
+			result += parts[i]
+		else:
+			result += values.get(parts[i], '')
+	return result
+
+def loadClientView():
+	"""
+		Fetches the client spec once and compiles its view into a ClientView.
+	"""
+	spec = clientSpec()
+	viewLines = []
+	counter = 0
+	while spec.has_key('View%d' % counter):
+		viewLines.append( spec['View%d' % counter] )
+		counter += 1
+	ignoreCase = isCaseInsensitive()
+	logging.debug( 'Client view of %s has %d lines' % (spec['Client'], len(viewLines)) )
+	return ClientView(spec['Client'], spec['Root'].strip(), viewLines, ignoreCase)
+
+def createFilename(filename, comment, defaultExtension='.zip'):
 	"""
 		Tries to make an intelligent filename for the .zip file that we are going to
 		store the changelist and the description in.
@@ -244,7 +779,7 @@ def createFilename(filename, comment):
 	name, ext = os.path.splitext(filename)
 	
 	if '' == ext:
-		ext = '.zip'
+		ext = defaultExtension
 	
 	# If requested, we want to insert some sanitized version of the beginning of the 
 	# changelist description into the filename so that it is easier to find with a visual
@@ -265,23 +800,15 @@ def createFilename(filename, comment):
 		counter += 1
 		
 
-def createDescription(changedfiles, comment, useClientRelativePaths):
+def createShelfEntries(changedfiles, metadata, unchangedFiles={}):
 	"""
-		Creates the metadata that we store in the meta file DESCRIPTION_FILENAME in the root of
-		the archive. This should contain enough information to fully restore the changelist 
-		from scratch.
+		Turns the opened files into the list of entries we store in the manifest, each entry is
+		a tuple of (revision, action, name, source path, archive name). The metadata is the bulk 
+		fstat result from collectFileMetadata.
+		
+		Files in unchangedFiles (keyed by depot name) get an empty archive name, which means
+		that there is no content stored and the base revision is all we need.
 	"""
-	description = ''
-
-	description += 'TIME: %s\n' % time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())
-	if useClientRelativePaths:
-		description += 'CLIENT: %s\n' % getClientName()
-	
-	if '' != comment:
-		description += 'INFO: """%s"""\n' % comment
-	
-	description += '\n\n'
-	
 	rootDir = clientRoot()
 	
 	# Some insane people might have a NULL clientroot, in which case we will have no choice but to do the absolute paths
@@ -289,159 +816,1687 @@ def createDescription(changedfiles, comment, useClientRelativePaths):
 	if 'null' == rootDir:
 		rootDir = ''
 	logging.info('My client root is: %s' % rootDir )
-	for name, revision, action in changedfiles:
+	entries = []
+	for name, revision, action, depotName in changedfiles:
+		stat = metadata[depotName]
 		sourcePath = ''
 		if action in ['branch', 'add', 'integrate', 'edit']:
-			sourcePath = findSourceDepotName(name)
+			sourcePath = sourceDepotName(stat)
 		
-		choppedName = depotNameToLocalClient(rootDir, depotNameToLocal(name))
-		desc = 'OPEN: %3d %s "%s" "%s" "%s"\n' % (revision, action, name, sourcePath, choppedName)
-		description += desc
-	
-	return description
+		choppedName = depotNameToLocalClient(rootDir, stat['clientFile'])
+		if unchangedFiles.has_key(depotName):
+			choppedName = ''
+		entries.append( (revision, action, name, sourcePath, choppedName) )
+	return entries
+
+def createDescription(entries, comment, useClientRelativePaths, shelf=0):
+	"""
+		Creates the metadata that we store in the meta file DESCRIPTION_FILENAME in the root of
+		the archive. This should contain enough information to fully restore the changelist 
+		from scratch. If the contents are shelved on the server, shelf is the changelist.
+	"""
+	header = {}
+	if shelf:
+		header['shelf'] = shelf
+	header['time'] = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())
+	if useClientRelativePaths:
+		header['client'] = getClientName()
+	if '' != comment:
+		header['comment'] = comment
+	return writeManifest(header, entries)
+
+def writeManifest(header, entries):
+	"""
+		Serializes a manifest as JSON lines:
+		
+		    {"format": "p4shelf-manifest", "version": 4, "files": N, ...header fields...}
+		    [revision, "action", "name", "source path", "archive name"]     (N lines)
+		    ["name", byte offset of its entry line]                        (N lines, sorted by name)
+		    {"indexOffset": byte offset of the first index line}
+		
+		Strings are stored as MANIFEST_ENCODING so that non utf-8 names round trip byte for byte.
+		The trailer on the last line lets lookupManifest find a single file with a binary search
+		of the index, without parsing the whole table.
+	"""
+	header = dict(header)
+	header['format'] = MANIFEST_FORMAT
+	header['version'] = MANIFEST_VERSION
+	header['files'] = len(entries)
+	lines = [ json.dumps(header, encoding=MANIFEST_ENCODING) ]
+	offset = len(lines[0]) + 1
+	offsets = []
+	for revision, action, name, sourcePath, chopped in entries:
+		line = json.dumps( [revision, action, name, sourcePath, chopped], encoding=MANIFEST_ENCODING )
+		offsets.append( (name, offset) )
+		lines.append(line)
+		offset += len(line) + 1
+	for name, entryOffset in sorted(offsets):
+		lines.append( json.dumps( [name, entryOffset], encoding=MANIFEST_ENCODING ) )
+	lines.append( json.dumps( {'indexOffset': offset} ) )
+	return '\n'.join(lines) + '\n'
+
+def isManifest(data):
+	return data.startswith('{')
+
+def fromJson(value, encoding=MANIFEST_ENCODING):
+	"""
+		The json module hands back unicode, the rest of the script (and perforce) deals in strings.
+	"""
+	if isinstance(value, unicode):
+		return value.encode(encoding)
+	return value
+
+def readManifestEntry(line, encoding=MANIFEST_ENCODING):
+	revision, action, name, sourcePath, chopped = json.loads(line)
+	return (int(revision), fromJson(action, encoding), fromJson(name, encoding), fromJson(sourcePath, encoding), fromJson(chopped, encoding))
+
+def readManifest(data):
+	"""
+		Parses a whole manifest, returns the header dictionary and the list of entries.
+	"""
+	lines = data.split('\n')
+	fields = json.loads(lines[0])
+	# Version 2 manifests were written assuming utf-8. Whatever follows the entries is the index,
+	# which isn't needed here.
+	encoding = fields.get('version', 0) < 3 and 'utf-8' or MANIFEST_ENCODING
+	header = {}
+	for key, value in fields.items():
+		header[fromJson(key, encoding)] = fromJson(value, encoding)
+	if header.get('format') != MANIFEST_FORMAT or header.get('version', 0) > MANIFEST_VERSION:
+		raise IOError('Unsupported manifest format %s version %s' % (header.get('format'), header.get('version')))
+	entries = [ readManifestEntry(line, encoding) for line in lines[1:1 + int(header['files'])] ]
+	return header, entries
+
+def lookupManifest(data, name):
+	"""
+		Finds the entry for a single file by a binary search of the sorted index, so only a
+		handful of lines are parsed whatever the size of the manifest. Returns None if the file
+		isn't in the manifest. Manifests from before the sorted index are simply parsed whole.
+	"""
+	if json.loads(data[:data.index('\n')]).get('version', 0) < 4:
+		header, entries = readManifest(data)
+		for entry in entries:
+			if entry[2] == name:
+				return entry
+		return None
 	
-def parseDescriptions(data):
+	trailerStart = data.rindex('\n', 0, len(data) - 1) + 1
+	low = json.loads(data[trailerStart:])['indexOffset']
+	high = trailerStart
+	while low < high:
+		lineStart = max( low, data.rfind('\n', low, (low + high) // 2) + 1 )
+		lineEnd = data.index('\n', lineStart)
+		indexName, offset = json.loads(data[lineStart:lineEnd])
+		indexName = fromJson(indexName)
+		if indexName == name:
+			return readManifestEntry( data[offset:data.index('\n', offset)] )
+		if indexName < name:
+			low = lineEnd + 1
+		else:
+			high = lineStart
+	return None
+
+def parseLegacyDescription(data):
+	"""
+		Parses the old line based text format, returns the same as readManifest.
+	"""
 	descriptions = string.split(data, '\n')
 	descriptions = map( string.strip, descriptions )
 	descriptions = filter( len, descriptions )
 	
-	openedFiles = []
-	comment = ''
-	time = ''
-	sourceClientName = ''
+	header = {}
+	entries = []
 	
 	timeRe = re.compile( '^TIME: (.*)' )
 	commentRe = re.compile( '^INFO: """(.*)"""', re.MULTILINE + re.DOTALL )
-	openRe = re.compile('^OPEN:\s+(\d+)\s+([a-z]+)\s+"(.+)"\s+"(.*)"\s+"(.+)"')
+	openRe = re.compile('^OPEN:\s+(\d+)\s+([a-z]+)\s+"(.+)"\s+"(.*)"\s+"(.*)"')
 	clientRe = re.compile( '^CLIENT: ([^\s]+)' )
 	
 	m = commentRe.search(data)
 	if m:
-		comment = m.group(1).strip()
-		logging.info( 'Comment = %s' % comment )
+		header['comment'] = m.group(1).strip()
 
 	for description in descriptions:
 		m = timeRe.match(description)
 		if m:
-			time = m.group(1)
-			logging.info( 'Archive time = %s' % time )
+			header['time'] = m.group(1)
 			continue
 		
 		m = clientRe.match(description)
 		if m:
-			sourceClientName = m.group(1)
+			header['client'] = m.group(1)
 		
 		m = openRe.match(description)
 		if m:
-			revision = int(m.group(1))
-			action = m.group(2)
-			name = m.group(3)
-			sourcePath = m.group(4)
-			chopped = m.group(5)
-			
-			# Now we need to transform both the name and the sourcepath into client relative files.
-			if len(sourceClientName):
-				name = toClientRelative(sourceClientName, name)
-				sourcePath = toClientRelative(sourceClientName, sourcePath)
-
-			if len(sourcePath):
-				logging.info( '%s on %s#%d from %s' % (action, name, revision, sourcePath) )
-			else:
-				logging.info( '%s on %s#%d' % (action, name, revision) )
-
-			openedFiles.append((revision, action, name, sourcePath, chopped))
+			entries.append( (int(m.group(1)), m.group(2), m.group(3), m.group(4), m.group(5)) )
 			continue
-			
-	return openedFiles, comment, time
 	
+	header['files'] = len(entries)
+	return header, entries
+
+def readDescription(data):
+	"""
+		Reads either kind of manifest, returns the header dictionary and the list of entries.
+	"""
+	if isManifest(data):
+		return readManifest(data)
+	return parseLegacyDescription(data)
+
+def interpretDescription(header, entries):
+	"""
+		Turns a parsed manifest into the list of opened files for this client, returns the list
+		together with the comment and the time of the archive.
+	"""
+	comment = header.get('comment', '').strip()
+	time = header.get('time', '')
+	sourceClientName = header.get('client', '')
+	if len(comment):
+		logging.info( 'Comment = %s' % comment )
+	if len(time):
+		logging.info( 'Archive time = %s' % time )
+	
+	openedFiles = []
+	for revision, action, name, sourcePath, chopped in entries:
+		# Now we need to transform both the name and the sourcepath into client relative files.
+		if len(sourceClientName):
+			name = toClientRelative(sourceClientName, name)
+			sourcePath = toClientRelative(sourceClientName, sourcePath)
+		openedFiles.append((revision, action, name, sourcePath, chopped))
 	
-def unpack(archive, chopped, depotName):
+	logOpenedFiles(openedFiles)
+	return openedFiles, comment, time
+
+def logOpenedFiles(openedFiles):
+	for revision, action, name, sourcePath, chopped in openedFiles:
+		if len(sourcePath):
+			logging.info( '%s on %s#%d from %s' % (action, name, revision, sourcePath) )
+		else:
+			logging.info( '%s on %s#%d' % (action, name, revision) )
+	
+def unpack(archive, chopped, depotName, view=None):
+	"""
+		Writes one member of the archive to wherever the depot file lives on this client. Returns
+		true if the file was written and false if the local file already had the same contents
+		(or if we are just faking it).
+	"""
 	if FAKEIT:
-		return
-	data = archive.read(chopped.replace('\\', '/'))
+		return 0
+	memberName = archiveMemberName(chopped)
 	
 	# Some users like to map their depot a little whacky, so we need to lookup the proper name
-	# on this client mapping.
-	clientFile = depotWhere(depotName)
+	# on this client mapping. The local view handles that without asking the server, but if it
+	# can't map the file we still ask perforce.
+	clientFile = None
+	if view:
+		clientFile = view.localPath(depotName)
+	if not clientFile:
+		clientFile = depotWhere(depotName)
+	# When reapplying a shelf most of the files are usually already there, and reading is a lot
+	# cheaper than writing. The size and CRC are right there in the zip directory.
+	info = archive.getinfo(memberName)
+	if isSameFile(clientFile, info.file_size, info.CRC):
+		logging.debug( '%s is already up to date' % clientFile )
+		return 0
+	
 	clientDir = os.path.dirname(clientFile)
 	if not os.path.isdir(clientDir):
 		os.makedirs(clientDir)
-	stream = open( clientFile, 'wb' )
-	stream.write(data)
-	stream.close()
-	
-def doExtract(filename):
-	archive = zipfile.ZipFile(filename, 'r')
-	openedFiles, comment, archiveTime = parseDescriptions( archive.read(DESCRIPTION_FILENAME) )
+	copyMember(archive, memberName, clientFile)
+	return 1
+
+def printShelvedFiles(names, shelf, view):
+	"""
+		Fetches the shelved contents of all the files with a single "p4 print" over an argument
+		file, and writes each file to its local name as the data streams in. Returns the number
+		of files written.
+		
+		The data comes in the server's form, so text files get the client's line endings here.
+		Types that need a charset translation are left to a "p4 print -o" of their own, which
+		writes them the way a sync would.
+	"""
+	lineEnd = clientLineEnd()
+	target = None
+	translate = 0
+	others = []
+	written = 0
+	try:
+		for entry in p4batchiter( 'print', ['%s@=%d' % (name, shelf) for name in names] ):
+			code = entry.get('code', '')
+			if 'stat' == code:
+				if target:
+					target.close()
+					target = None
+				clientFile = view.localPath(entry['depotFile'])
+				if not clientFile:
+					clientFile = depotWhere(entry['depotFile'])
+				clientDir = os.path.dirname(clientFile)
+				if not os.path.isdir(clientDir):
+					os.makedirs(clientDir)
+				kind = fileTypeKind(entry.get('type', 'binary'))
+				if 'other' == kind:
+					others.append( (entry['depotFile'], clientFile) )
+					continue
+				logging.debug( 'Printing %s to %s' % (entry['depotFile'], clientFile) )
+				target = open(clientFile, 'wb')
+				translate = 'text' == kind and '\n' != lineEnd
+				written += 1
+			elif 'error' == code:
+				logging.warning( 'print: %s' % entry.get('data', '').strip() )
+			elif target and entry.has_key('data'):
+				if translate:
+					target.write(entry['data'].replace('\n', lineEnd))
+				else:
+					target.write(entry['data'])
+	finally:
+		if target:
+			target.close()
 	
-	syncOptions = ''
-	changelist = ''
-	if FAKEIT: 
-		syncOptions = '-n'
-	else:
-		no = createChangelist(comment)
-		changelist = '-c %d' % no
+	for depotFile, clientFile in others:
+		logging.debug( 'Printing %s to %s through perforce' % (depotFile, clientFile) )
+		errors = [entry for entry in p4( 'print -q -o "%s" "%s@=%d"' % (clientFile, depotFile, shelf) ) if 'error' == entry.get('code')]
+		for entry in errors:
+			logging.warning( 'print: %s' % entry.get('data', '').strip() )
+		if not len(errors):
+			written += 1
+	return written
+
+def serverSupportsShelving():
+	"""
+		Server side shelving arrived in the 2009.2 server.
+	"""
+	for entry in serverInfo():
+		m = re.search( r'/(\d{4})\.(\d+)/', entry.get('serverVersion', '') )
+		if m:
+			return (int(m.group(1)), int(m.group(2))) >= (2009, 2)
+	return 0
+
+def crc32File(filename):
+	crc = 0
+	for chunk in readChunks(filename):
+		crc = zlib.crc32(chunk, crc)
+	return crc & 0xffffffffL
+
+def isSameFile(filename, size, crc):
+	"""
+		True if the local file exists and has the given size and CRC. The CRC is only calculated
+		when the size matches.
+	"""
+	try:
+		if os.path.getsize(filename) != size:
+			return 0
+		return crc32File(filename) == crc
+	except (OSError, IOError):
+		return 0
+
+def copyMember(archive, memberName, targetName):
+	"""
+		Streams a member out of the archive into a file, one chunk at a time, and checks the CRC
+		as the data goes past. The memory use is bounded by the chunk size, not the file size.
+	"""
+	info = archive.getinfo(memberName)
+	source = archive.open(memberName)
+	crc = 0
+	size = 0
+	try:
+		target = open(targetName, 'wb')
+		try:
+			while 1:
+				chunk = source.read(COMPRESS_CHUNK)
+				if not chunk:
+					break
+				crc = zlib.crc32(chunk, crc)
+				size += len(chunk)
+				target.write(chunk)
+		finally:
+			target.close()
+	finally:
+		source.close()
+	if (crc & 0xffffffffL) != info.CRC or size != info.file_size:
+		raise IOError( 'Failed to extract %s, the data is damaged (crc or size mismatch)' % memberName )
 	
-	rootDir = clientRoot()
+def planExtract(openedFiles):
+	"""
+		Plans the whole extraction up front. The per file logic is the same as it always was:
+		
+		    integrated add/edit : sync, integrate, resolve -at, edit, unpack
+		    branch              : sync, integrate
+		    edit                : sync, edit, unpack (unless unchanged)
+		    add                 : sync, unpack, add
+		    delete              : sync, delete
+		
+		but instead of walking file by file, every step is grouped over all the files, so that
+		each step is a single p4 invocation over an argument file. Since the steps come in the 
+		same order as above, each file still sees its operations in the same order.
+		
+		Returns a list of (step, arguments) tuples. Integrate takes pairs of (source, target)
+		and unpack takes pairs of (archive name, depot name), the rest take plain filenames.
+	"""
+	sync = []
+	integrate = []
+	resolve = []
+	edit = []
+	unpackFiles = []
+	add = []
+	delete = []
 	for revision, action, name, sourcePath, chopped in openedFiles:
-		p4( 'sync %s "%s#%d"' % (syncOptions, name, revision) )
+		sync.append( '%s#%d' % (name, revision) )
 		if len(sourcePath):
 			if action == 'branch':
-				p4( 'integrate %s %s "%s" "%s"' % (changelist, syncOptions, sourcePath, name) )
+				integrate.append( (sourcePath, name) )
 			if action in ['add', 'edit']:
-				p4( 'integrate %s %s "%s" "%s"' % (changelist, syncOptions, sourcePath, name) )
-				p4( 'resolve %s -at "%s"' % (syncOptions, name) )
-				p4( 'edit %s %s "%s"' % (changelist, syncOptions, name) )
-				unpack(archive, chopped, name)
+				integrate.append( (sourcePath, name) )
+				resolve.append( name )
+				edit.append( name )
+				unpackFiles.append( (chopped, name) )
 		else:
 			if action == 'edit':
-				p4( 'edit %s %s "%s"' % (changelist, syncOptions, name) )
-				unpack(archive, chopped, name)
+				edit.append( name )
+				if len(chopped):
+					unpackFiles.append( (chopped, name) )
 			if action == 'add':
-				unpack(archive, chopped, name)
-				p4( 'add %s %s "%s"' % (changelist, syncOptions, name) )
+				unpackFiles.append( (chopped, name) )
+				add.append( name )
 			if action == 'delete':
-				p4( 'delete %s %s "%s"' % (changelist, syncOptions, name) )
+				delete.append( name )
+	
+	return [ ('sync', sync),
+			 ('integrate', integrate),
+			 ('resolve', resolve),
+			 ('edit', edit),
+			 ('unpack', unpackFiles),
+			 ('add', add),
+			 ('delete', delete) ]
+
+class ExtractJournal:
+	"""
+		Remembers how far an extraction got, so that an interrupted one can be resumed without
+		creating another changelist or redoing the work. The journal is a small text file next to
+		the archive with lines like:
+		
+			CHANGE: 1234
+			PLAN: sync,integrate,resolve,edit,unpack,add,delete
+			FILE: 4 //depot/foo/bar.cpp
+			STEP: 4
+		
+		A STEP line is written once a whole step of the plan is done, FILE lines are written as
+		each file of the steps that work file by file (integrate and unpack) is done. Every line
+		is flushed as soon as it is written, so the journal is never behind the client.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.changelist = 0
+		self.plan = ''
+		self.steps = set()
+		self.files = set()
+		self.output = None
+	
+	def load(self, plan):
+		"""
+			Reads an existing journal, returns true if there is one that was written for the
+			same plan.
+		"""
+		if not os.path.isfile(self.filename):
+			return 0
+		for line in open(self.filename, 'rt').read().splitlines():
+			key, _, value = line.partition(': ')
+			if 'CHANGE' == key:
+				self.changelist = int(value)
+			elif 'PLAN' == key:
+				self.plan = value
+			elif 'STEP' == key:
+				self.steps.add(int(value))
+			elif 'FILE' == key:
+				step, _, name = value.partition(' ')
+				self.files.add( (int(step), name) )
+		if self.plan != plan:
+			logging.warning( 'The journal %s was written for a different extraction, starting over' % self.filename )
+			self.steps = set()
+			self.files = set()
+			return 0
+		return self.changelist > 0
+	
+	def start(self, changelist, plan):
+		self.changelist = changelist
+		self.plan = plan
+		self.steps = set()
+		self.files = set()
+		self.output = open(self.filename, 'wt')
+		self.write( 'CHANGE: %d' % changelist )
+		self.write( 'PLAN: %s' % plan )
+	
+	def resume(self):
+		self.output = open(self.filename, 'at')
+	
+	def write(self, line):
+		self.output.write(line + '\n')
+		self.output.flush()
+	
+	def isStepDone(self, step):
+		return step in self.steps
+	
+	def isFileDone(self, step, name):
+		return (step, name) in self.files
+	
+	def stepDone(self, step):
+		self.steps.add(step)
+		self.write( 'STEP: %d' % step )
+	
+	def fileDone(self, step, name):
+		self.files.add( (step, name) )
+		self.write( 'FILE: %d %s' % (step, name) )
+	
+	def finish(self):
+		self.output.close()
+		self.output = None
+		os.remove(self.filename)
+
+def planSignature(plan):
+	return ','.join([step for step, arguments in plan])
+
+def runExtractPlan(plan, archive, changelist, syncOptions, shelf=0, journal=None):
+	"""
+		Executes a plan from planExtract, returns the number of p4 invocations it took. If shelf is
+		given, the file contents come from that server side shelf instead of the archive. If a
+		journal is given, steps and files it already has are skipped and new ones are recorded.
+	"""
+	view = None
+	invocations = 0
+	for index, (step, arguments) in enumerate(plan):
+		if journal and journal.isStepDone(index):
+			logging.debug( 'Step %s was already done' % step )
+			continue
+		if journal and step in ('integrate', 'unpack'):
+			arguments = [(source, name) for source, name in arguments if not journal.isFileDone(index, name)]
+		if not len(arguments):
+			if journal:
+				journal.stepDone(index)
+			continue
+		logging.debug( 'Step %s over %d files' % (step, len(arguments)) )
+		if 'unpack' == step:
+			if not view and not FAKEIT:
+				view = loadClientView()
+				invocations += 1
+			written = 0
+			if shelf:
+				if not FAKEIT:
+					written = printShelvedFiles([name for chopped, name in arguments], shelf, view)
+					invocations += 1
+			else:
+				for chopped, name in arguments:
+					written += unpack(archive, chopped, name, view)
+					if journal:
+						journal.fileDone(index, name)
+			if not FAKEIT:
+				logging.info( 'Wrote %d files, %d were already up to date' % (written, len(arguments) - written) )
+		elif 'integrate' == step:
+			# Integrate wants a source and a target per invocation, so these can't go into one
+			# argument file. Luckily they are rare compared to the rest.
+			for sourcePath, name in arguments:
+				p4( 'integrate %s %s "%s" "%s"' % (changelist, syncOptions, sourcePath, name) )
+				invocations += 1
+				if journal:
+					journal.fileDone(index, name)
+		else:
+			if 'sync' == step:
+				p4batch( 'sync %s' % syncOptions, arguments )
+			elif 'resolve' == step:
+				p4batch( 'resolve %s -at' % syncOptions, arguments )
+			else:
+				p4batch( '%s %s %s' % (step, changelist, syncOptions), arguments )
+			invocations += 1
+		if journal:
+			journal.stepDone(index)
+	return invocations
+
+def doExtract(filename, restoreSyncState, resume):
+	archive = openArchive(filename)
+	header, entries = readDescription( archive.read(DESCRIPTION_FILENAME) )
+	openedFiles, comment, archiveTime = interpretDescription(header, entries)
+	shelf = int(header.get('shelf', 0))
+	if shelf:
+		logging.info( 'File contents come from the server side shelf in changelist %d' % shelf )
+	
+	plan = []
+	if restoreSyncState:
+		if SYNCSTATE_FILENAME in archive.namelist():
+			lastchange, revdiffs = readSyncState( archive.read(SYNCSTATE_FILENAME) )
+			logging.info( 'Restoring sync state of changelist %d with %d exceptions' % (lastchange, len(revdiffs)) )
+			plan = planSyncState(lastchange, revdiffs)
+		else:
+			logging.warning( 'The archive has no sync state recorded, leaving the client as it is' )
+	
+	plan += planExtract(openedFiles)
+	
+	syncOptions = ''
+	changelist = ''
+	journal = None
+	if FAKEIT: 
+		syncOptions = '-n'
+	else:
+		journal = ExtractJournal(filename + '.journal')
+		if resume and journal.load(planSignature(plan)):
+			no = journal.changelist
+			journal.resume()
+			logging.info( 'Resuming the extraction into changelist %d' % no )
+		else:
+			no = createChangelist(comment)
+			journal.start(no, planSignature(plan))
+		changelist = '-c %d' % no
 	
+	invocations = runExtractPlan(plan, archive, changelist, syncOptions, shelf, journal)
+	if journal:
+		journal.finish()
+	logging.info( 'Extracted %d files with %d p4 invocations' % (len(openedFiles), invocations) )
 	return 0
 
-def doCompress(filename, changelist, comment, overwriteTarget, useClientRelativePaths):
-	changedfiles = collectOpenedFiles(changelist, useClientRelativePaths)	
-	description = createDescription(changedfiles, comment, useClientRelativePaths)
+def archiveMemberName(name):
+	"""
+		Normalizes a chopped filename into the member name used inside the zip, exactly the
+		way ZipFile.write does it (no drive, no leading slashes, forward slashes).
+	"""
+	name = os.path.normpath(os.path.splitdrive(name.replace('\\', '/'))[1])
+	while name[0] in (os.sep, os.altsep):
+		name = name[1:]
+	return name.replace(os.sep, '/')
+
+def compressionRatio(data):
+	"""
+		How small the fastest deflate level gets the data, compressed size over raw size. This is
+		a single pass in zlib, which lets go of the GIL so the compressing threads don't queue up
+		behind it the way a per byte histogram in python does.
+	"""
+	if not len(data):
+		return 1.0
+	return len(zlib.compress(data, 1)) / float(len(data))
+
+def chooseCodec(localName, sample):
+	"""
+		Picks the compression for a file, either 'store' or a deflate level. Extension overrides
+		in CODECS win, otherwise already compressed data (that a quick deflate of the sample can't
+		shrink) is stored, plain text style data gets the best deflate level and the rest the default.
+	"""
+	ext = os.path.splitext(localName)[1].lower()
+	if CODECS.has_key(ext):
+		return CODECS[ext]
+	if len(sample) < 512:
+		return 6
+	ratio = compressionRatio(sample)
+	if ratio > 0.95:
+		return 'store'
+	if ratio < 0.5:
+		return 9
+	return 6
+
+def codecName(codec):
+	if 'store' == codec:
+		return 'stored'
+	return 'deflate-%d' % codec
+
+def deflateMember(localName, archiveName):
+	"""
+		Compresses a single file into a spooled temporary file and returns the zip header information
+		together with the compressed data, the codec it picked and the time it took. This is what the
+		worker threads run, zlib lets go of the interpreter lock while it works so the threads really
+		do run in parallel. The spool keeps the memory use bounded even for huge files.
+	"""
+	startTime = time.time()
+	st = os.stat(localName)
+	info = zipfile.ZipInfo(archiveName, time.localtime(st.st_mtime)[0:6])
+	info.external_attr = (st.st_mode & 0xFFFF) << 16L
+	
+	spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+	crc = 0
+	size = 0
+	stream = open(localName, 'rb')
+	try:
+		chunk = stream.read(COMPRESS_CHUNK)
+		codec = chooseCodec(localName, chunk[:CODEC_SAMPLE])
+		logging.debug( 'Now compressing %s (%s)' % (localName, codecName(codec)) )
+		if 'store' == codec:
+			info.compress_type = zipfile.ZIP_STORED
+			compressor = None
+		else:
+			info.compress_type = zipfile.ZIP_DEFLATED
+			compressor = zlib.compressobj(codec, zlib.DEFLATED, -zlib.MAX_WBITS)
+		while chunk:
+			size += len(chunk)
+			crc = zlib.crc32(chunk, crc)
+			if compressor:
+				spool.write(compressor.compress(chunk))
+			else:
+				spool.write(chunk)
+			chunk = stream.read(COMPRESS_CHUNK)
+		if compressor:
+			spool.write(compressor.flush())
+	finally:
+		stream.close()
+	
+	info.file_size = size
+	info.compress_size = spool.tell()
+	info.CRC = crc & 0xffffffffL
+	spool.seek(0)
+	return info, spool, codec, time.time() - startTime
+
+def appendMember(archive, info, spool):
+	"""
+		Appends an already compressed member to an archive opened for writing. This is the 
+		same bookkeeping that ZipFile.write does, minus the compression.
+	"""
+	archive._writecheck(info)
+	archive._didModify = True
+	info.header_offset = archive.fp.tell()
+	archive.fp.write(info.FileHeader())
+	shutil.copyfileobj(spool, archive.fp, COMPRESS_CHUNK)
+	spool.close()
+	archive.filelist.append(info)
+	archive.NameToInfo[info.filename] = info
+
+def compressMembers(archive, members, workers):
+	"""
+		Compresses the list of (local filename, archive name) pairs on a pool of threads and
+		appends the finished members to the archive in the original order. Only a small window
+		of members is in flight at any time.
+		
+		Returns a dictionary from codec name to [files, uncompressed bytes, compressed bytes, seconds].
+	"""
+	stats = {}
+	def finish(result):
+		info, spool, codec, seconds = result.get()
+		appendMember(archive, info, spool)
+		stat = stats.setdefault(codecName(codec), [0, 0, 0, 0.0])
+		stat[0] += 1
+		stat[1] += info.file_size
+		stat[2] += info.compress_size
+		stat[3] += seconds
+	
+	pool = ThreadPool(workers)
+	try:
+		pending = collections.deque()
+		for localName, archiveName in members:
+			pending.append( pool.apply_async(deflateMember, (localName, archiveName)) )
+			while len(pending) > workers * 2 or (len(pending) and pending[0].ready()):
+				finish(pending.popleft())
+		while len(pending):
+			finish(pending.popleft())
+	finally:
+		pool.terminate()
+	return stats
+
+class StoreArchive:
+	"""
+		A shelf kept in a content addressed store. The shelf itself is just a small text manifest
+		that maps each member name to the sha1 of its contents, the contents live (deflated) in
+		the objects directory next to the manifest, one file per unique sha1. Many manifests share
+		the same objects, so shelving the same files over and over again only costs the hashing.
+		
+		The interface mimics the parts of zipfile.ZipFile that we use, so extraction doesn't need
+		to care where the data comes from.
+	"""
+	def __init__(self, filename, mode='r'):
+		self.filename = filename
+		self.mode = mode
+		self.objectRoot = os.path.join(os.path.dirname(os.path.abspath(filename)), STORE_OBJECTS)
+		self.entries = {}
+		self.order = []
+		if 'w' == mode and os.path.splitext(filename)[1].lower() != STORE_EXTENSION:
+			# The garbage collector has to be able to tell the manifests apart from zips.
+			raise IOError('Store manifests must end in %s, not %s' % (STORE_EXTENSION, filename))
+		if 'r' == mode:
+			self.entries, self.order = readStoreManifest(filename)
+	
+	def namelist(self):
+		return list(self.order)
+	
+	def read(self, name):
+		digest, size, crc = self.entries[archiveMemberName(name)]
+		stream = open(storeObjectPath(self.objectRoot, digest), 'rb')
+		try:
+			data = zlib.decompress(stream.read())
+		finally:
+			stream.close()
+		if len(data) != size:
+			raise IOError('Object %s for %s is damaged' % (digest, name))
+		return data
+	
+	def open(self, name):
+		digest, size, crc = self.entries[archiveMemberName(name)]
+		return StoreObjectReader(storeObjectPath(self.objectRoot, digest))
+	
+	def getinfo(self, name):
+		name = archiveMemberName(name)
+		digest, size, crc = self.entries[name]
+		info = zipfile.ZipInfo(name)
+		info.file_size = size
+		info.CRC = crc
+		return info
+	
+	def writestr(self, name, data):
+		self.add(name, storeData(self.objectRoot, data))
+	
+	def write(self, localName, name):
+		self.add(name, storeFile(self.objectRoot, localName))
+	
+	def add(self, name, objectInfo):
+		name = archiveMemberName(name)
+		if not self.entries.has_key(name):
+			self.order.append(name)
+		self.entries[name] = objectInfo
+	
+	def close(self):
+		if 'w' != self.mode:
+			return
+		lines = [STORE_HEADER]
+		for name in self.order:
+			digest, size, crc = self.entries[name]
+			lines.append('OBJECT: %s %d %d "%s"' % (digest, size, crc, name))
+		stream = open(self.filename, 'wt')
+		stream.write('\n'.join(lines) + '\n')
+		stream.close()
+
+class StoreObjectReader:
+	"""
+		File like object that inflates a store object as it is being read.
+	"""
+	def __init__(self, path):
+		self.stream = open(path, 'rb')
+		self.decompressor = zlib.decompressobj()
+		self.pending = ''
+	
+	def read(self, size):
+		while not len(self.pending):
+			if len(self.decompressor.unconsumed_tail):
+				data = self.decompressor.unconsumed_tail
+			else:
+				data = self.stream.read(COMPRESS_CHUNK)
+			if not data:
+				self.pending = self.decompressor.flush()
+				break
+			self.pending = self.decompressor.decompress(data, size)
+		result = self.pending[:size]
+		self.pending = self.pending[size:]
+		return result
+	
+	def close(self):
+		self.stream.close()
+
+def readStoreManifest(filename):
+	"""
+		Parses a store manifest, returns a dictionary from member name to (sha1, size, crc) and the
+		list of member names in the order they were stored.
+	"""
+	stream = open(filename, 'rt')
+	lines = map( string.strip, stream.readlines() )
+	stream.close()
+	if not len(lines) or lines[0] != STORE_HEADER:
+		raise IOError('%s is neither a zip file nor a p4shelf store manifest' % filename)
+	
+	objectRe = re.compile( '^OBJECT: ([0-9a-f]{40}) (\d+) (\d+) "(.+)"$' )
+	entries = {}
+	order = []
+	for line in lines[1:]:
+		m = objectRe.match(line)
+		if m:
+			name = m.group(4)
+			entries[name] = (m.group(1), int(m.group(2)), int(m.group(3)))
+			order.append(name)
+	return entries, order
+
+def storeObjectPath(objectRoot, digest):
+	return os.path.join(objectRoot, digest[:2], digest[2:])
+
+def storeData(objectRoot, data):
+	"""
+		Puts a string into the store, returns (sha1, size, crc).
+	"""
+	digest = hashlib.sha1(data).hexdigest()
+	crc = zlib.crc32(data) & 0xffffffffL
+	path = storeObjectPath(objectRoot, digest)
+	if not os.path.isfile(path):
+		writeStoreObject(path, [data])
+	return digest, len(data), crc
+
+def storeFile(objectRoot, localName):
+	"""
+		Puts a file into the store, returns (sha1, size, crc). The file is hashed first and only
+		read again to be written if the store doesn't already have the contents.
+	"""
+	hasher = hashlib.sha1()
+	crc = 0
+	size = 0
+	stream = open(localName, 'rb')
+	try:
+		while 1:
+			chunk = stream.read(COMPRESS_CHUNK)
+			if not chunk:
+				break
+			hasher.update(chunk)
+			crc = zlib.crc32(chunk, crc)
+			size += len(chunk)
+	finally:
+		stream.close()
+	
+	digest = hasher.hexdigest()
+	path = storeObjectPath(objectRoot, digest)
+	if os.path.isfile(path):
+		logging.debug( 'Already stored %s as %s' % (localName, digest) )
+	else:
+		logging.debug( 'Storing %s as %s' % (localName, digest) )
+		writeStoreObject(path, readChunks(localName))
+	return digest, size, crc & 0xffffffffL
+
+def readChunks(filename):
+	stream = open(filename, 'rb')
+	try:
+		while 1:
+			chunk = stream.read(COMPRESS_CHUNK)
+			if not chunk:
+				break
+			yield chunk
+	finally:
+		stream.close()
+
+def writeStoreObject(path, chunks):
+	"""
+		Deflates the chunks into a temporary file next to the object and then moves it in place,
+		so that a half written object never shows up under its real name.
+	"""
+	objectDir = os.path.dirname(path)
+	if not os.path.isdir(objectDir):
+		os.makedirs(objectDir)
+	handle, tempName = tempfile.mkstemp('.tmp', 'new', objectDir)
+	stream = os.fdopen(handle, 'wb')
+	try:
+		compressor = zlib.compressobj()
+		for chunk in chunks:
+			stream.write(compressor.compress(chunk))
+		stream.write(compressor.flush())
+		stream.close()
+		os.rename(tempName, path)
+	except:
+		stream.close()
+		os.remove(tempName)
+		if not os.path.isfile(path):
+			raise
+
+def storeMembers(archive, members, workers):
+	"""
+		Puts the list of (local filename, archive name) pairs into the store on a pool of threads,
+		hashlib and zlib both let go of the interpreter lock on large buffers.
+		
+		Returns a tuple of (number of files, bytes hashed).
+	"""
+	def store(member):
+		return storeFile(archive.objectRoot, member[0])
+	pool = ThreadPool(workers)
+	try:
+		results = pool.map(store, members)
+	finally:
+		pool.terminate()
+	rawBytes = 0
+	for (localName, archiveName), objectInfo in zip(members, results):
+		archive.add(archiveName, objectInfo)
+		rawBytes += objectInfo[1]
+	return len(members), rawBytes
+
+def openArchive(filename):
+	"""
+		Opens either a zip shelf or a store manifest for reading.
+	"""
+	if zipfile.is_zipfile(filename):
+		return zipfile.ZipFile(filename, 'r')
+	return StoreArchive(filename, 'r')
+
+def isStoreManifest(filename):
+	stream = open(filename, 'rb')
+	try:
+		return stream.readline(len(STORE_HEADER) + 2).rstrip('\r\n') == STORE_HEADER
+	finally:
+		stream.close()
+
+def findStoreManifests(storeDir):
+	"""
+		Returns all the store manifests in the directory, going by their contents rather than
+		their names. Missing one would make the garbage collector throw away its objects.
+	"""
+	manifests = []
+	for filename in os.listdir(storeDir):
+		path = os.path.join(storeDir, filename)
+		if os.path.isfile(path) and isStoreManifest(path):
+			manifests.append(path)
+	return manifests
+
+def doGarbageCollect(storeDir):
+	"""
+		Removes all the objects in the store that no manifest in the directory refers to.
+	"""
+	referenced = {}
+	manifests = findStoreManifests(storeDir)
+	for manifest in manifests:
+		entries, order = readStoreManifest(manifest)
+		for digest, size, crc in entries.values():
+			referenced[digest] = 1
+	logging.info( '%d manifests refer to %d objects' % (len(manifests), len(referenced)) )
+	
+	removedCount = 0
+	removedBytes = 0
+	objectRoot = os.path.join(storeDir, STORE_OBJECTS)
+	for dirpath, dirnames, filenames in os.walk(objectRoot):
+		for filename in filenames:
+			if filename.endswith('.tmp'):
+				continue # Being written by a shelve right now, see writeStoreObject.
+			digest = os.path.basename(dirpath) + filename
+			if referenced.has_key(digest):
+				continue
+			path = os.path.join(dirpath, filename)
+			removedCount += 1
+			removedBytes += os.path.getsize(path)
+			logging.debug( 'Removing %s' % path )
+			if not FAKEIT:
+				os.remove(path)
+	if FAKEIT:
+		logging.info( 'Would remove %d unreferenced objects (%d bytes)' % (removedCount, removedBytes) )
+	else:
+		logging.info( 'Removed %d unreferenced objects (%d bytes)' % (removedCount, removedBytes) )
+	return 0
+
+CATALOG_SCHEMA = [
+	'CREATE TABLE IF NOT EXISTS archives (id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER, time TEXT, comment TEXT, client TEXT)',
+	'CREATE TABLE IF NOT EXISTS files (archive INTEGER, name TEXT, revision INTEGER, action TEXT, source TEXT, chopped TEXT)',
+	'CREATE INDEX IF NOT EXISTS files_name ON files (name)',
+	'CREATE INDEX IF NOT EXISTS files_archive ON files (archive)',
+]
+
+def openCatalog(catalogName):
+	db = sqlite3.connect(catalogName)
+	db.text_factory = str
+	for statement in CATALOG_SCHEMA:
+		db.execute(statement)
+	return db
+
+def findArchives(directory):
+	"""
+		Yields the full path of every shelf archive (zips and store manifests) under the directory.
+	"""
+	for dirpath, dirnames, filenames in os.walk(directory):
+		if STORE_OBJECTS in dirnames:
+			dirnames.remove(STORE_OBJECTS)
+		for filename in filenames:
+			if os.path.splitext(filename)[1].lower() in ('.zip', STORE_EXTENSION):
+				yield os.path.abspath(os.path.join(dirpath, filename))
+
+def catalogArchive(db, path, mtime, size):
+	"""
+		Reads the manifest of one archive into the catalog, replacing whatever was there.
+	"""
+	try:
+		archive = openArchive(path)
+		try:
+			header, entries = readDescription( archive.read(DESCRIPTION_FILENAME) )
+		finally:
+			archive.close()
+	except (zipfile.BadZipfile, KeyError, IOError, ValueError), e:
+		logging.warning( 'Skipping %s, it is not a readable shelf (%s)' % (path, e) )
+		return 0
+	db.execute( 'DELETE FROM files WHERE archive IN (SELECT id FROM archives WHERE path = ?)', (path,) )
+	db.execute( 'DELETE FROM archives WHERE path = ?', (path,) )
+	cursor = db.execute( 'INSERT INTO archives (path, mtime, size, time, comment, client) VALUES (?, ?, ?, ?, ?, ?)',
+		(path, mtime, size, header.get('time', ''), header.get('comment', '').strip(), header.get('client', '')) )
+	archiveId = cursor.lastrowid
+	db.executemany( 'INSERT INTO files (archive, name, revision, action, source, chopped) VALUES (?, ?, ?, ?, ?, ?)',
+		[(archiveId, name, revision, action, sourcePath, chopped) for revision, action, name, sourcePath, chopped in entries] )
+	return 1
+
+def doUpdateCatalog(catalogName, directory):
+	"""
+		Brings the catalog up to date with the archives under the directory. Only archives that
+		are new or whose modification time or size changed are read again, and archives that
+		are gone are dropped from the catalog.
+	"""
+	db = openCatalog(catalogName)
+	known = {}
+	prefix = os.path.join(os.path.abspath(directory), '')
+	for path, mtime, size in db.execute( 'SELECT path, mtime, size FROM archives' ):
+		if path.startswith(prefix):
+			known[path] = (mtime, size)
+	
+	seen = {}
+	read = 0
+	for path in findArchives(directory):
+		stat = os.stat(path)
+		seen[path] = 1
+		if known.get(path) == (stat.st_mtime, stat.st_size):
+			continue
+		logging.debug( 'Reading %s' % path )
+		read += catalogArchive(db, path, stat.st_mtime, stat.st_size)
+	
+	removed = 0
+	for path in known.keys():
+		if seen.has_key(path):
+			continue
+		logging.debug( 'Dropping %s' % path )
+		db.execute( 'DELETE FROM files WHERE archive IN (SELECT id FROM archives WHERE path = ?)', (path,) )
+		db.execute( 'DELETE FROM archives WHERE path = ?', (path,) )
+		removed += 1
+	db.commit()
+	db.close()
+	logging.info( 'Catalog has %d archives under %s, read %d and dropped %d' % (len(seen), directory, read, removed) )
+	return 0
+
+def catalogPattern(pattern):
+	"""
+		Turns a perforce style file pattern ("..." and "*") into an sqlite GLOB pattern.
+	"""
+	result = ''
+	for token in re.split( r'(\.\.\.|\*|\?|\[)', pattern ):
+		if token in ('...', '*'):
+			result += '*'
+		elif token in ('?', '['):
+			result += '[%s]' % token
+		else:
+			result += token
+	return result
+
+def doQueryCatalog(catalogName, pattern):
+	"""
+		Prints every shelved file matching the pattern together with the archive it's in, newest
+		archives first.
+	"""
+	db = openCatalog(catalogName)
+	query = 'SELECT files.name, files.revision, files.action, archives.path, archives.time, archives.comment ' \
+		'FROM files JOIN archives ON files.archive = archives.id '
+	if '...' in pattern or '*' in pattern:
+		rows = db.execute( query + 'WHERE files.name GLOB ? ORDER BY archives.mtime DESC, files.name', (catalogPattern(pattern),) )
+	else:
+		rows = db.execute( query + 'WHERE files.name = ? ORDER BY archives.mtime DESC', (pattern,) )
+	count = 0
+	for name, revision, action, path, archiveTime, comment in rows:
+		print '%s#%d %s %s (%s) %s' % (name, revision, action, path, archiveTime, comment.split('\n')[0])
+		count += 1
+	db.close()
+	logging.info( '%d matches' % count )
+	return 0
+
+class DigestCache:
+	"""
+		Remembers the CRC of local files together with their modification time and size, so
+		that comparing a big workspace against shelves over and over only reads the files that
+		actually changed since last time.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.digests = {}
+		self.dirty = 0
+		try:
+			for path, digest in json.load(open(filename, 'rt')).items():
+				self.digests[fromJson(path)] = digest
+		except (IOError, ValueError, UnicodeError):
+			self.digests = {}
+	
+	def crc(self, path):
+		stat = os.stat(path)
+		cached = self.digests.get(path)
+		if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+			return cached[2]
+		crc = crc32File(path)
+		self.digests[path] = [stat.st_mtime, stat.st_size, crc]
+		self.dirty = 1
+		return crc
+	
+	def save(self):
+		if not self.dirty:
+			return
+		handle, tempName = tempfile.mkstemp('.tmp', 'p4shelf', os.path.dirname(self.filename))
+		stream = os.fdopen(handle, 'wt')
+		json.dump(self.digests, stream, encoding=MANIFEST_ENCODING)
+		stream.close()
+		try:
+			os.rename(tempName, self.filename)
+		except OSError:
+			# Windows doesn't rename on top of an existing file.
+			os.remove(self.filename)
+			os.rename(tempName, self.filename)
+
+def shelfMembers(archive, entries):
+	"""
+		Returns a dictionary from the name of each file in the manifest to its action and the
+		zip directory entry of its contents (None when the contents aren't in the archive).
+	"""
+	names = set(archive.namelist())
+	result = {}
+	for revision, action, name, sourcePath, chopped in entries:
+		info = None
+		if len(chopped) and archiveMemberName(chopped) in names:
+			info = archive.getinfo(archiveMemberName(chopped))
+		result[name] = (action, info)
+	return result
+
+def printContentDiff(before, after, beforeName, afterName):
+	if '\0' in before[:8192] or '\0' in after[:8192]:
+		print 'Binary files %s and %s differ' % (beforeName, afterName)
+		return
+	for line in difflib.unified_diff(before.splitlines(True), after.splitlines(True), beforeName, afterName):
+		sys.stdout.write(line)
+		if not line.endswith('\n'):
+			sys.stdout.write('\n')
+
+def reportDiff(results, state, name):
+	results.append( (state, name) )
+	print '%-10s %s' % (state, name)
+
+def diffShelves(filename, otherFilename, showContent):
+	"""
+		Compares two shelves by the sizes and CRCs in their directories, without asking perforce
+		anything. Files only in the first shelf are missing, files only in the second are extra.
+	"""
+	archive = openArchive(filename)
+	other = openArchive(otherFilename)
+	header, entries = readDescription( archive.read(DESCRIPTION_FILENAME) )
+	otherHeader, otherEntries = readDescription( other.read(DESCRIPTION_FILENAME) )
+	mine = shelfMembers(archive, entries)
+	theirs = shelfMembers(other, otherEntries)
+	
+	results = []
+	for name in sorted(set(mine.keys()) | set(theirs.keys())):
+		if not theirs.has_key(name):
+			reportDiff(results, 'missing', name)
+			continue
+		if not mine.has_key(name):
+			reportDiff(results, 'extra', name)
+			continue
+		action, info = mine[name]
+		otherAction, otherInfo = theirs[name]
+		if action != otherAction:
+			state = 'modified'
+		elif 'delete' == action:
+			state = 'identical'
+		elif not info or not otherInfo:
+			state = 'unverified'
+		elif (info.file_size, info.CRC) == (otherInfo.file_size, otherInfo.CRC):
+			state = 'identical'
+		else:
+			state = 'modified'
+		reportDiff(results, state, name)
+		if showContent and 'modified' == state and info and otherInfo:
+			printContentDiff(archive.read(info.filename), other.read(otherInfo.filename), 
+				'%s:%s' % (filename, name), '%s:%s' % (otherFilename, name))
+	return results
+
+def diffWorkspace(filename, showContent):
+	"""
+		Compares a shelf against the files in the client, by size first and then by the CRC of
+		the local file (through the digest cache). Files opened in the client that the shelf
+		doesn't have are extra.
+	"""
+	archive = openArchive(filename)
+	header, entries = readDescription( archive.read(DESCRIPTION_FILENAME) )
+	sourceClientName = header.get('client', '')
+	members = shelfMembers(archive, entries)
+	view = loadClientView()
+	cache = DigestCache(DIGEST_CACHE)
+	
+	results = []
+	names = {}
+	for revision, action, name, sourcePath, chopped in sorted(entries, key=lambda entry: entry[2]):
+		info = members[name][1]
+		if len(sourceClientName):
+			name = toClientRelative(sourceClientName, name)
+		names[name] = 1
+		localName = view.localPath(name)
+		if not localName:
+			localName = depotWhere(name)
+		exists = os.path.isfile(localName)
+		if 'delete' == action:
+			state = ('identical', 'modified')[exists]
+		elif not exists:
+			state = 'missing'
+		elif not info:
+			# The contents are not in the archive (unchanged files or a server side shelf), so
+			# all we know is that the file is there.
+			state = 'unverified'
+		elif os.path.getsize(localName) == info.file_size and cache.crc(localName) == info.CRC:
+			state = 'identical'
+		else:
+			state = 'modified'
+		reportDiff(results, state, name)
+		if showContent and 'modified' == state and info and exists:
+			printContentDiff(archive.read(info.filename), open(localName, 'rb').read(), 
+				'%s:%s' % (filename, name), localName)
+	
+	for entry in p4iter( 'opened' ):
+		name = entry['depotFile']
+		if len(sourceClientName):
+			name = entry['clientFile']
+		if not names.has_key(name):
+			reportDiff(results, 'extra', name)
+	cache.save()
+	return results
+
+def doDiff(filenames, showContent):
+	if len(filenames) > 1:
+		results = diffShelves(filenames[0], filenames[1], showContent)
+	else:
+		results = diffWorkspace(filenames[0], showContent)
+	counts = collections.defaultdict(int)
+	for state, name in results:
+		counts[state] += 1
+	logging.info( '%d identical, %d modified, %d missing, %d extra, %d unverified' % 
+		(counts['identical'], counts['modified'], counts['missing'], counts['extra'], counts['unverified']) )
+	return 0
+
+def verifyMembers(arguments):
+	"""
+		Decompresses the given members of an archive without writing them anywhere and checks
+		their CRC and size. Runs in a worker process, so it opens the archive on its own.
+		Returns a tuple of (list of problems, bytes checked).
+	"""
+	filename, names = arguments
+	problems = []
+	checked = 0
+	archive = openArchive(filename)
+	try:
+		for name in names:
+			info = archive.getinfo(name)
+			crc = 0
+			size = 0
+			try:
+				source = archive.open(name)
+				try:
+					while 1:
+						chunk = source.read(COMPRESS_CHUNK)
+						if not chunk:
+							break
+						crc = zlib.crc32(chunk, crc)
+						size += len(chunk)
+				finally:
+					source.close()
+			except (zipfile.BadZipfile, zlib.error, IOError, OSError), e:
+				problems.append( '%s: %s' % (name, e) )
+				continue
+			if (crc & 0xffffffffL) != info.CRC:
+				problems.append( '%s: crc is %08x, should be %08x' % (name, crc & 0xffffffffL, info.CRC) )
+			elif size != info.file_size:
+				problems.append( '%s: size is %d, should be %d' % (name, size, info.file_size) )
+			checked += size
+	finally:
+		archive.close()
+	return problems, checked
 
-	openedFiles, comment, archiveTime = parseDescriptions( description )
+def verifyChunks(archive):
+	"""
+		Splits the members of an archive into chunks of at most VERIFY_MEMBERS members or
+		VERIFY_CHUNK bytes, so that one big archive is still spread over all the workers.
+	"""
+	chunks = []
+	chunk = []
+	chunkSize = 0
+	for name in archive.namelist():
+		size = archive.getinfo(name).file_size
+		if len(chunk) and (len(chunk) >= VERIFY_MEMBERS or chunkSize + size > VERIFY_CHUNK):
+			chunks.append(chunk)
+			chunk = []
+			chunkSize = 0
+		chunk.append(name)
+		chunkSize += size
+	if len(chunk):
+		chunks.append(chunk)
+	return chunks
 
+def verifyArchive(filename, pool):
+	"""
+		Checks one archive, returns a report dictionary.
+	"""
+	startTime = time.time()
+	report = { 'archive' : filename, 'members' : 0, 'bytes' : 0, 'problems' : [] }
+	problems = report['problems']
+	try:
+		archive = openArchive(filename)
+		try:
+			names = set(archive.namelist())
+			header, entries = readDescription( archive.read(DESCRIPTION_FILENAME) )
+			chunks = verifyChunks(archive)
+		finally:
+			archive.close()
+	except (zipfile.BadZipfile, KeyError, IOError, ValueError), e:
+		problems.append( 'unreadable: %s' % e )
+		report['ok'] = False
+		return report
+	
+	# The manifest and the directory should agree on what's in the archive.
+	report['files'] = len(entries)
+	expected = set([DESCRIPTION_FILENAME, SYNCSTATE_FILENAME])
+	for revision, action, name, sourcePath, chopped in entries:
+		if 'delete' == action or not len(chopped) or header.get('shelf'):
+			continue
+		memberName = archiveMemberName(chopped)
+		expected.add(memberName)
+		if memberName not in names:
+			problems.append( '%s: missing from the archive' % name )
+	for name in sorted(names - expected):
+		problems.append( '%s: not in the manifest' % name )
+	
+	for chunkProblems, checked in pool.map(verifyMembers, [(filename, chunk) for chunk in chunks]):
+		problems += chunkProblems
+		report['bytes'] += checked
+	report['members'] = len(names)
+	report['ok'] = not len(problems)
+	report['seconds'] = round(time.time() - startTime, 3)
+	return report
+
+def doVerify(filenames, workers):
+	"""
+		Verifies all the archives on a pool of processes and prints one JSON report per archive.
+		Returns 0 if all of them are fine.
+	"""
+	pool = multiprocessing.Pool(workers)
+	failed = 0
+	try:
+		for filename in filenames:
+			report = verifyArchive(filename, pool)
+			print json.dumps(report, sort_keys=True, encoding=MANIFEST_ENCODING)
+			if not report['ok']:
+				failed += 1
+				logging.error( '%s has %d problems' % (filename, len(report['problems'])) )
+	finally:
+		pool.close()
+		pool.join()
+	logging.info( 'Verified %d archives, %d failed' % (len(filenames), failed) )
+	return int(failed > 0)
+
+def doRawExtract(filename, root, workers):
+	"""
+		Writes the files of the shelf straight under the root directory by their client relative
+		names, without perforce and without a client. Each thread has its own handle on the
+		archive so the members are read and decompressed in parallel. Returns non zero if some
+		files of the shelf could not be written.
+	"""
+	archive = openArchive(filename)
+	header, entries = readDescription( archive.read(DESCRIPTION_FILENAME) )
+	names = set(archive.namelist())
+	archive.close()
+	root = os.path.abspath(root)
+	
+	members = []
+	skipped = 0
+	for revision, action, name, sourcePath, chopped in entries:
+		if 'delete' == action:
+			continue
+		memberName = archiveMemberName(chopped)
+		if not len(chopped) or memberName not in names:
+			# Unchanged files (--skip-unchanged) and server side shelves only have metadata here.
+			logging.info( 'No contents for %s in the archive' % name )
+			skipped += 1
+			continue
+		targetName = os.path.normpath( os.path.join(root, memberName.replace('/', os.sep)) )
+		if not targetName.startswith( os.path.join(root, '') ):
+			logging.warning( 'Skipping %s, it would end up outside of %s' % (memberName, root) )
+			skipped += 1
+			continue
+		members.append( (memberName, targetName) )
+	if skipped:
+		logging.warning( '%d files of the shelf were not written, see above' % skipped )
+	
 	if FAKEIT:
+		for memberName, targetName in members:
+			logging.info( 'Would write %s' % targetName )
+		return int(skipped > 0)
+	
+	handles = threading.local()
+	opened = []
+	def write(member):
+		memberName, targetName = member
+		if not hasattr(handles, 'archive'):
+			handles.archive = openArchive(filename)
+			opened.append(handles.archive)
+		info = handles.archive.getinfo(memberName)
+		if isSameFile(targetName, info.file_size, info.CRC):
+			return 0
+		targetDir = os.path.dirname(targetName)
+		if not os.path.isdir(targetDir):
+			try:
+				os.makedirs(targetDir)
+			except OSError:
+				pass # Another thread got there first.
+		copyMember(handles.archive, memberName, targetName)
+		return 1
+	
+	startTime = time.time()
+	pool = ThreadPool(workers)
+	try:
+		written = sum(pool.map(write, members))
+	finally:
+		pool.close()
+		pool.join()
+		for handle in opened:
+			handle.close()
+	elapsed = max(time.time() - startTime, 0.001)
+	logging.info( 'Wrote %d files under %s in %.1f seconds, %d were already up to date' % 
+		(written, root, elapsed, len(members) - written) )
+	return int(skipped > 0)
+
+def chooseBackend(backend):
+	"""
+		Returns true if we should shelve the files on the server. Asking for the server explicitly
+		on a server that can't shelve is an error, auto quietly falls back to the archive.
+	"""
+	if 'zip' == backend:
 		return 0
+	if serverSupportsShelving():
+		return 1
+	if 'server' == backend:
+		raise IOError( 'The server does not support shelving (needs 2009.2), use --backend=zip' )
+	logging.info( 'The server does not support shelving, storing the files in the archive' )
+	return 0
+
+def shelveOnServer(changelist, openedFiles, comment):
+	"""
+		Shelves the opened files into a new pending changelist and returns its number. The files
+		are only borrowed for the shelve and reopened back into their changelist afterwards, so
+		that one never has shelved files (which would stop it from being submitted) and shelving
+		it again later makes a new shelf instead of replacing the one this archive points at.
+	"""
+	names = [name for revision, action, name, sourcePath, chopped in openedFiles]
+	description = 'p4shelf archive of changelist %s' % (changelist or 'default')
+	if '' != comment:
+		description += '\n%s' % comment
+	shelf = createChangelist(description, 0)
+	try:
+		p4batch( 'reopen -c %d' % shelf, names )
+		try:
+			logging.info( 'Shelving the files on the server in changelist %d' % shelf )
+			p4( 'shelve -c %d' % shelf )
+		finally:
+			p4batch( 'reopen -c %s' % (changelist or 'default'), names )
+	except:
+		logging.error( 'Failed to shelve into changelist %d, it may have to be deleted by hand' % shelf )
+		raise
+	return shelf
+
+def prepareShelf(changedfiles, metadata, workers, skipUnchanged):
+	"""
+		Works out what goes into the shelf of the opened files, returns a tuple of
+		
+		(shelf entries, dictionary from filename to local filename)
+	"""
+	unchangedFiles = {}
+	if skipUnchanged:
+		unchangedFiles = findUnchangedFiles(changedfiles, metadata, workers)
+	openedFiles = createShelfEntries(changedfiles, metadata, unchangedFiles)
+	localNames = {}
+	for name, revision, action, depotName in changedfiles:
+		localNames[name] = metadata[depotName]['clientFile']
+	return openedFiles, localNames
+
+def doCompress(filename, changelist, comment, overwriteTarget, useClientRelativePaths, workers, useStore, skipUnchanged, recordSyncState, backend):
+	serverShelf = chooseBackend(backend)
+	changedfiles = collectOpenedFiles(changelist, useClientRelativePaths)	
+	metadata = collectFileMetadata([depotName for name, revision, action, depotName in changedfiles])
+	openedFiles, localNames = prepareShelf(changedfiles, metadata, workers, skipUnchanged)
+	logOpenedFiles(openedFiles)
+	
+	syncState = ''
+	if recordSyncState:
+		syncState = collectSyncState()
+
+	if FAKEIT:
+		return 0
+
+	return writeShelf(filename, changelist, openedFiles, comment, useClientRelativePaths, syncState, localNames, serverShelf, overwriteTarget, workers, useStore)
 
+def collectSyncState():
+	lastchange, revdiffs = findFileRevisions()
+	logging.info( 'Client is synced to changelist %d with %d exceptions' % (lastchange, len(revdiffs)) )
+	return writeSyncState(lastchange, revdiffs)
+
+def writeShelf(filename, changelist, openedFiles, comment, useClientRelativePaths, syncState, localNames, serverShelf, overwriteTarget, workers, useStore):
+	"""
+		Writes the archive for a prepared shelf of the changelist, returns 0 on success. With
+		serverShelf the contents are shelved on the server and only the metadata is archived.
+	"""
 	if os.path.exists(filename) and not overwriteTarget:
 		logging.error( 'Refusing to overwrite existing file %s (give -o to override)' % filename )
 		return 1
 	
+	shelf = 0
+	if serverShelf:
+		shelf = shelveOnServer(changelist, openedFiles, comment)
+	description = createDescription(openedFiles, comment, useClientRelativePaths, shelf)
+	
 	# Create the path for sure before we create an archive.
 	try:
 		os.makedirs( os.path.dirname(filename) )
-	except WindowsError:
+	except OSError:
 		pass # Probably already existed.
 	logging.info( 'Now compressing into %s' % filename )
-	archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
-	print description
+	if useStore:
+		archive = StoreArchive(filename, 'w')
+	else:
+		archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, True)
 	archive.writestr(DESCRIPTION_FILENAME, description)
+	if len(syncState):
+		archive.writestr(SYNCSTATE_FILENAME, syncState)
+	if shelf:
+		archive.close()
+		logging.info( 'Wrote the metadata for %d files shelved in changelist %d' % (len(openedFiles), shelf) )
+		return 0
 
+	members = []
 	for revision, action, name, sourcePath, chopped in openedFiles:
-		if action == 'delete':
+		if action == 'delete' or not len(chopped):
 			continue
 		archiveName = chopped
-		localName = depotNameToLocal(name)
-		logging.debug( 'Now compressing %s' % localName )
-		archive.write(localName, archiveName.replace('\\', '/'))
-		
+		localName = localNames[name]
+		members.append( (localName, archiveMemberName(archiveName)) )
+	
+	startTime = time.time()
+	if useStore:
+		count, rawBytes = storeMembers(archive, members, workers)
+		archive.close()
+		elapsed = max(time.time() - startTime, 0.001)
+		logging.info( 'Stored %d files, %d bytes in %.1f seconds (%.1f MB/s with %d workers)' % 
+			(count, rawBytes, elapsed, rawBytes / elapsed / (1024.0 * 1024.0), workers) )
+		return 0
+	
+	stats = compressMembers(archive, members, workers)
 	archive.close()
+	elapsed = max(time.time() - startTime, 0.001)
+	count = 0
+	rawBytes = 0
+	compressedBytes = 0
+	for name, (files, raw, compressed, seconds) in sorted(stats.items()):
+		logging.info( '  %-10s: %d files, %d -> %d bytes (saved %d) in %.1f seconds of work' % 
+			(name, files, raw, compressed, raw - compressed, seconds) )
+		count += files
+		rawBytes += raw
+		compressedBytes += compressed
+	logging.info( 'Compressed %d files, %d -> %d bytes in %.1f seconds (%.1f MB/s with %d workers)' % 
+		(count, rawBytes, compressedBytes, elapsed, rawBytes / elapsed / (1024.0 * 1024.0), workers) )
 	return 0
 
+def shelfFilename(filename, comment, exactFileName, useDescriptiveArchiveNames, useStore):
+	if exactFileName:
+		if useStore:
+			return storeFilename(filename)
+		return filename
+	desc = ''
+	if useDescriptiveArchiveNames:
+		desc = comment
+	extension = '.zip'
+	if useStore:
+		extension = STORE_EXTENSION
+		filename = storeFilename(filename)
+	return createFilename(filename, desc, extension)
+
+def storeFilename(filename):
+	"""
+		Store manifests always get the STORE_EXTENSION, whatever the user asked for.
+	"""
+	name, ext = os.path.splitext(filename)
+	if ext.lower() == STORE_EXTENSION:
+		return filename
+	result = name + STORE_EXTENSION
+	if len(ext):
+		logging.info( 'Store manifests always end in %s, writing %s' % (STORE_EXTENSION, result) )
+	return result
+
+def doCompressMany(filename, changelists, comment, overwriteTarget, useClientRelativePaths, workers, useStore, skipUnchanged, recordSyncState, backend, exactFileName, useDescriptiveArchiveNames):
+	"""
+		Shelves several changelists in one go, one archive per changelist with the changelist
+		number in the filename. An empty list of changelists means all of them with opened files.
+		
+		The server is only asked once for the opened files, their metadata, the changelist
+		descriptions and the sync state, and the archives are written in parallel with the
+		workers split between them.
+	"""
+	opened = collectOpenedChangelists(useClientRelativePaths)
+	if not len(changelists):
+		changelists = sorted(opened.keys())
+	if not len(changelists):
+		logging.info( 'There are no opened files to shelve' )
+		return 0
+	
+	depotNames = []
+	for changelist in changelists:
+		if changelist not in opened:
+			logging.warning( 'No opened files in changelist %d' % changelist )
+			opened[changelist] = []
+		depotNames += [depotName for name, revision, action, depotName in opened[changelist]]
+	metadata = collectFileMetadata(depotNames)
+	descriptions = {}
+	if '' == comment:
+		descriptions = pendingDescriptions()
+	
+	syncState = ''
+	if recordSyncState:
+		syncState = collectSyncState()
+	
+	archiveWorkers = max(1, workers // len(changelists))
+	serverShelf = chooseBackend(backend)
+	shelves = []
+	for changelist in changelists:
+		changeComment = comment
+		if '' == changeComment:
+			changeComment = descriptions.get(changelist, '')
+		logging.info( 'Changelist %s:' % (changelist or 'default') )
+		openedFiles, localNames = prepareShelf(opened[changelist], metadata, archiveWorkers, skipUnchanged)
+		logOpenedFiles(openedFiles)
+		name, ext = os.path.splitext(filename)
+		changeFilename = shelfFilename('%s_%s%s' % (name, changelist or 'default', ext), changeComment, exactFileName, useDescriptiveArchiveNames, useStore)
+		shelves.append( (changeFilename, changelist, openedFiles, changeComment, useClientRelativePaths, syncState, localNames, serverShelf, overwriteTarget, archiveWorkers, useStore) )
+
+	if FAKEIT:
+		return 0
+
+	pool = ThreadPool( min(workers, len(shelves)) )
+	try:
+		results = [pool.apply_async(writeShelf, arguments) for arguments in shelves]
+		return max([result.get() for result in results])
+	finally:
+		pool.close()
+		pool.join()
+
 def main( argv ):
 	try:
-		opts, args = getopt.getopt( argv, 's:m:c:u:p:yqvczhfdor', ['archive-desc'] )
+		opts, args = getopt.getopt( argv, 's:m:c:u:p:yqvczhfdor', ['archive-desc', 'workers=', 'store', 'gc', 'skip-unchanged', 'codec=', 'sync-state', 'backend=', 'resume', 'catalog=', 'find=', 'diff', 'content', 'verify', 'raw='] )
 	except getopt.GetoptError:
 		print HELP
 		return 1
@@ -451,13 +2506,32 @@ def main( argv ):
 	fakeit = 1
 	comment	= ''
 	changelist = 0
+	changelists = None
 	exactFileName = 0
 	openHeadRevision = 0
 	overwriteTarget = 0
 	useClientRelativePaths = 0
 	useDescriptiveArchiveNames = 0
+	workers = multiprocessing.cpu_count()
+	useStore = 0
+	collectGarbage = 0
+	skipUnchanged = 0
+	syncState = 0
+	resume = 0
+	catalogName = ''
+	findPattern = ''
+	diff = 0
+	showContent = 0
+	verify = 0
+	rawRoot = ''
+	backend = 'zip'
 	global COMMON_FLAGS
 	COMMON_FLAGS = ''
+	# p4branch calls main() more than once and changes the client spec in between, so nothing
+	# cached from a previous run can be trusted.
+	CLIENT_NAMES.clear()
+	SERVER_INFO.clear()
+	CLIENT_SPECS.clear()
 	
 	for o,a in opts:
 		if '-v' == o:
@@ -480,7 +2554,12 @@ def main( argv ):
 		if '-m' == o:
 			comment = a
 		if '-s' == o:
-			changelist = int(a)
+			if 'all' == a:
+				changelists = []
+			elif ',' in a:
+				changelists = [int(change) for change in a.split(',') if len(change.strip())]
+			else:
+				changelist = int(a)
 		if '-f' == o:
 			exactFileName = 1
 		if '-d' == o:
@@ -491,11 +2570,57 @@ def main( argv ):
 			useClientRelativePaths = 1
 		if '--archive-desc' == o:
 			useDescriptiveArchiveNames = 1
-	if len(args) != 1:
+		if '--workers' == o:
+			workers = max(1, int(a))
+		if '--codec' == o:
+			try:
+				ext, codec = a.rsplit(':', 1)
+				if 'store' != codec:
+					codec = int(codec)
+					if 0 == codec:
+						codec = 'store'
+					elif codec < 0 or codec > 9:
+						raise ValueError(a)
+			except ValueError:
+				print 'Invalid codec %s, should be <extension>:store or <extension>:<level 1-9>' % a
+				return 1
+			if not ext.startswith('.'):
+				ext = '.' + ext
+			CODECS[ext.lower()] = codec
+		if '--store' == o:
+			useStore = 1
+		if '--gc' == o:
+			collectGarbage = 1
+		if '--skip-unchanged' == o:
+			skipUnchanged = 1
+		if '--sync-state' == o:
+			syncState = 1
+		if '--resume' == o:
+			resume = 1
+		if '--catalog' == o:
+			catalogName = a
+		if '--find' == o:
+			findPattern = a
+		if '--diff' == o:
+			diff = 1
+		if '--content' == o:
+			showContent = 1
+		if '--verify' == o:
+			verify = 1
+		if '--raw' == o:
+			rawRoot = a
+		if '--backend' == o:
+			if a not in ['zip', 'server', 'auto']:
+				print 'Unknown backend %s, should be zip, server or auto' % a
+				return 1
+			backend = a
+	if len(args) != 1 and not len(findPattern) and not (diff and len(args) == 2) and not (verify and len(args)):
 		print 'No filename given!'
 		print HELP
 		return 1
-	filename = args[0]
+	filename = ''
+	if len(args):
+		filename = args[0]
 
 	global VERBOSE
 	global FAKEIT
@@ -507,20 +2632,31 @@ def main( argv ):
 	else:
 		logging.basicConfig( level=logging.INFO, format=os.path.basename(sys.argv[0]) + ': %(message)s' )
 
-	if fakeit: logging.info( 'Fake mode, no actions will be taken' )
+	if fakeit and not len(catalogName) and not diff and not verify: logging.info( 'Fake mode, no actions will be taken' )
 
+	if collectGarbage:
+		return doGarbageCollect(filename)
+	if len(catalogName) and len(findPattern):
+		return doQueryCatalog(catalogName, findPattern)
+	if len(catalogName):
+		return doUpdateCatalog(catalogName, filename)
+	if diff:
+		return doDiff(args, showContent)
+	if verify:
+		return doVerify(args, workers)
+	if len(rawRoot):
+		return doRawExtract(filename, rawRoot, workers)
 	if extract:
-		return doExtract(filename)
+		return doExtract(filename, syncState, resume)
+	elif changelists is not None:
+		return doCompressMany(filename, changelists, comment, overwriteTarget, useClientRelativePaths, workers, useStore, skipUnchanged, syncState, backend, exactFileName, useDescriptiveArchiveNames)
 	else:
 		if 0 != changelist and comment == '':
 			result = p4('change -o %d' % changelist)[0]
 			comment = result['Description'].rstrip()
-		if not exactFileName:
-			desc = ''
-			if useDescriptiveArchiveNames:
-				desc = comment
-			filename = createFilename(filename, desc)
-		return doCompress(filename, changelist, comment, overwriteTarget, useClientRelativePaths)
+		filename = shelfFilename(filename, comment, exactFileName, useDescriptiveArchiveNames, useStore)
+		return doCompress(filename, changelist, comment, overwriteTarget, useClientRelativePaths, workers, useStore, skipUnchanged, syncState, backend)
 
 if __name__ == '__main__':
+	multiprocessing.freeze_support()
 	sys.exit( main(sys.argv[1:] ) )
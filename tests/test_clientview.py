@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Checks the in-process client view matcher in p4shelf against the way perforce
+# maps files through a client view. Run with: python -m unittest discover -s tests
+#
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import p4shelf
+
+def makeView(lines, ignoreCase=0):
+	return p4shelf.ClientView('ws', '/work', lines, ignoreCase)
+
+class ExclusionTest(unittest.TestCase):
+	def setUp(self):
+		self.view = makeView([
+			'//depot/... //ws/...',
+			'-//depot/secret/... //ws/secret/...',
+		])
+	
+	def testExcludedFileIsNotMapped(self):
+		self.assertEqual(None, self.view.clientPath('//depot/secret/key.txt'))
+		self.assertEqual(None, self.view.localPath('//depot/secret/key.txt'))
+	
+	def testOtherFilesAreMapped(self):
+		self.assertEqual('//ws/src/main.cpp', self.view.clientPath('//depot/src/main.cpp'))
+	
+	def testExcludedClientPathHasNoDepotFile(self):
+		self.assertEqual([], self.view.depotPaths('//ws/secret/key.txt'))
+	
+	def testIncludeAfterExclude(self):
+		view = makeView([
+			'//depot/... //ws/...',
+			'-//depot/secret/... //ws/secret/...',
+			'//depot/secret/public/... //ws/secret/public/...',
+		])
+		self.assertEqual('//ws/secret/public/a.txt', view.clientPath('//depot/secret/public/a.txt'))
+		self.assertEqual(None, view.clientPath('//depot/secret/b.txt'))
+
+class OverlayTest(unittest.TestCase):
+	def setUp(self):
+		self.view = makeView([
+			'//depot/base/... //ws/...',
+			'+//depot/patch/... //ws/...',
+		])
+	
+	def testBothDepotFilesMapToTheSameClientFile(self):
+		self.assertEqual('//ws/a.txt', self.view.clientPath('//depot/base/a.txt'))
+		self.assertEqual('//ws/a.txt', self.view.clientPath('//depot/patch/a.txt'))
+	
+	def testLaterOverlayWins(self):
+		self.assertEqual(['//depot/patch/a.txt', '//depot/base/a.txt'], self.view.depotPaths('//ws/a.txt'))
+	
+	def testOverlayBelowRegularLineIsHidden(self):
+		view = makeView([
+			'+//depot/patch/... //ws/...',
+			'//depot/base/... //ws/...',
+		])
+		self.assertEqual(None, view.clientPath('//depot/patch/a.txt'))
+		self.assertEqual(['//depot/base/a.txt'], view.depotPaths('//ws/a.txt'))
+
+class HidingTest(unittest.TestCase):
+	def testLaterLineHidesEarlierClientPath(self):
+		view = makeView([
+			'//depot/old/... //ws/code/...',
+			'//depot/new/... //ws/code/...',
+		])
+		self.assertEqual(None, view.clientPath('//depot/old/a.txt'))
+		self.assertEqual('//ws/code/a.txt', view.clientPath('//depot/new/a.txt'))
+		self.assertEqual(['//depot/new/a.txt'], view.depotPaths('//ws/code/a.txt'))
+	
+	def testOnlyTheOverlappingPartIsHidden(self):
+		view = makeView([
+			'//depot/old/... //ws/code/...',
+			'//depot/new/... //ws/code/lib/...',
+		])
+		self.assertEqual('//ws/code/a.txt', view.clientPath('//depot/old/a.txt'))
+		self.assertEqual(None, view.clientPath('//depot/old/lib/a.txt'))
+	
+	def testLaterLineRemapsDepotFile(self):
+		view = makeView([
+			'//depot/... //ws/...',
+			'//depot/tools/... //ws/bin/...',
+		])
+		self.assertEqual('//ws/bin/run.py', view.clientPath('//depot/tools/run.py'))
+		self.assertEqual([], view.depotPaths('//ws/tools/run.py'))
+
+class WildcardTest(unittest.TestCase):
+	def testEllipsisMatchesAcrossDirectories(self):
+		view = makeView(['//depot/src/... //ws/code/...'])
+		self.assertEqual('//ws/code/a/b/c.cpp', view.clientPath('//depot/src/a/b/c.cpp'))
+	
+	def testStarStaysWithinDirectory(self):
+		view = makeView(['//depot/top/* //ws/top/*'])
+		self.assertEqual('//ws/top/a.txt', view.clientPath('//depot/top/a.txt'))
+		self.assertEqual(None, view.clientPath('//depot/top/sub/a.txt'))
+	
+	def testMixedWildcards(self):
+		view = makeView(['//depot/.../*.cpp //ws/src/.../*.cxx'])
+		self.assertEqual('//ws/src/a/b/main.cxx', view.clientPath('//depot/a/b/main.cpp'))
+		self.assertEqual(None, view.clientPath('//depot/a/b/main.h'))
+	
+	def testPositionalWildcardsReorder(self):
+		view = makeView(['//depot/%%1/%%2.txt //ws/%%2/%%1.txt'])
+		self.assertEqual('//ws/name/dir.txt', view.clientPath('//depot/dir/name.txt'))
+		self.assertEqual(['//depot/dir/name.txt'], view.depotPaths('//ws/name/dir.txt'))
+
+class QuotingTest(unittest.TestCase):
+	def testQuotedPathsWithSpaces(self):
+		view = makeView(['"//depot/my project/..." "//ws/other dir/..."'])
+		self.assertEqual('//ws/other dir/a b.txt', view.clientPath('//depot/my project/a b.txt'))
+		self.assertEqual(os.path.join('/work', 'other dir', 'a b.txt'), view.localPath('//depot/my project/a b.txt'))
+	
+	def testExclusionInsideAndOutsideQuotes(self):
+		for line in ['"-//depot/my project/tmp/..." "//ws/other dir/tmp/..."', '-"//depot/my project/tmp/..." "//ws/other dir/tmp/..."']:
+			view = makeView(['"//depot/my project/..." "//ws/other dir/..."', line])
+			self.assertEqual(None, view.clientPath('//depot/my project/tmp/a.txt'))
+			self.assertEqual('//ws/other dir/b.txt', view.clientPath('//depot/my project/b.txt'))
+	
+	def testEscapedCharactersInLocalPath(self):
+		view = makeView(['//depot/... //ws/...'])
+		self.assertEqual(os.path.join('/work', 'a@b#c.txt'), view.localPath('//depot/a%40b%23c.txt'))
+
+class CaseTest(unittest.TestCase):
+	def testCaseSensitiveServer(self):
+		view = makeView(['//depot/Src/... //ws/src/...'])
+		self.assertEqual(None, view.clientPath('//depot/src/a.txt'))
+		self.assertEqual(None, view.clientPath('//WS/src/a.txt'))
+	
+	def testCaseInsensitiveServer(self):
+		view = makeView(['//depot/Src/... //ws/src/...', '-//depot/Src/Tmp/... //ws/src/tmp/...'], 1)
+		self.assertEqual('//ws/src/A.txt', view.clientPath('//DEPOT/src/A.txt'))
+		self.assertEqual(None, view.clientPath('//depot/SRC/tmp/a.txt'))
+		self.assertEqual('//WS/src/a.txt', view.clientPath('//WS/src/a.txt'))
+
+if __name__ == '__main__':
+	unittest.main()
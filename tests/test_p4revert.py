@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Checks how p4revert folds and plans a revert, against a small depot kept in memory
+# instead of a server. Run with: python -m unittest discover -s tests
+#
+import os
+import re
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import p4revert
+
+class FakeDepot:
+	"""
+		Stands in for the few perforce commands the planner asks. Each file is a list of
+		(changelist, action), revision 1 first.
+	"""
+	def __init__(self, files, ignoreCase=False):
+		self.files = files
+		self.ignoreCase = ignoreCase
+		self.batches = []
+
+	def key(self, name):
+		if self.ignoreCase:
+			return name.lower()
+		return name
+
+	def changelistFiles(self, spec):
+		m = re.match(r'-a "//\.\.\.@(\d+),@(\d+)"$', spec)
+		if m:
+			first, last = int(m.group(1)), int(m.group(2))
+		else:
+			first = last = int(re.match(r'"//\.\.\.@=(\d+)"$', spec).group(1))
+		results = []
+		for name in sorted(self.files.keys(), key=self.key):
+			revisions = self.files[name]
+			for revision in range(len(revisions), 0, -1):
+				change, action = revisions[revision - 1]
+				if first <= change <= last:
+					results.append( (name, action, revision) )
+		return iter(results)
+
+	def fstat(self, arguments):
+		results = []
+		for argument in arguments:
+			name = argument.split('#')[0]
+			revisions = self.files[name]
+			revision = len(revisions)
+			if '#' in argument:
+				revision = int(argument.split('#')[1])
+			if revision < 1:
+				continue
+			results.append( {'code' : 'stat', 'depotFile' : name, 'headRev' : str(revision),
+				'headAction' : revisions[revision - 1][1], 'clientFile' : '/ws/' + name[len('//depot/'):]} )
+		return results
+
+	def p4batch(self, command, arguments):
+		if 'fstat' == command:
+			return self.fstat(arguments)
+		self.batches.append( (command, list(arguments)) )
+		return []
+
+class DepotTestCase(unittest.TestCase):
+	def setUp(self):
+		self.saved = (p4revert.changelistFiles, p4revert.p4batch, p4revert.isCaseInsensitive, p4revert.BATCH_SIZE)
+
+	def tearDown(self):
+		p4revert.changelistFiles, p4revert.p4batch, p4revert.isCaseInsensitive, p4revert.BATCH_SIZE = self.saved
+
+	def useDepot(self, files, ignoreCase=False):
+		self.depot = FakeDepot(files, ignoreCase)
+		p4revert.changelistFiles = self.depot.changelistFiles
+		p4revert.p4batch = self.depot.p4batch
+		p4revert.isCaseInsensitive = lambda: ignoreCase
+
+	def plan(self, argument, force=False):
+		first, last, numbers = p4revert.parseChangelists(argument)
+		return p4revert.planRevert( list(p4revert.netChanges(first, last, numbers)), force )
+
+class ParseChangelistsTest(unittest.TestCase):
+	def testSingleChangelist(self):
+		self.assertEqual( (12, 12, set([12])), p4revert.parseChangelists('12') )
+
+	def testRange(self):
+		self.assertEqual( (12, 19, None), p4revert.parseChangelists('12-19') )
+
+	def testList(self):
+		self.assertEqual( (12, 19, set([12, 15, 19])), p4revert.parseChangelists('19,12,15') )
+
+	def testNotANumber(self):
+		self.assertRaises( ValueError, p4revert.parseChangelists, 'twelve' )
+		self.assertRaises( ValueError, p4revert.parseChangelists, ',' )
+
+class NetChangesTest(DepotTestCase):
+	def testRangeFoldsEachFileOnce(self):
+		self.useDepot({
+			'//depot/a.c' : [(1, 'add'), (10, 'edit'), (11, 'edit')],
+			'//depot/b.c' : [(11, 'add')],
+		})
+		self.assertEqual( [('//depot/a.c', 'edit', 2, 'edit', 3, 2), ('//depot/b.c', 'add', 1, 'add', 1, 1)],
+			list(p4revert.netChanges(10, 11, None)) )
+
+	def testListSkipsTheChangelistsInBetween(self):
+		self.useDepot({
+			'//depot/a.c' : [(1, 'add'), (10, 'edit'), (11, 'edit'), (12, 'delete')],
+		})
+		self.assertEqual( [('//depot/a.c', 'edit', 2, 'delete', 4, 2)],
+			list(p4revert.netChanges(10, 12, set([10, 12]))) )
+
+	def testListKeepsTheRevisionsOfAFileTogetherWhenCaseIsIgnored(self):
+		self.useDepot({
+			'//depot/bar.c' : [(1, 'add'), (2, 'add'), (3, 'add'), (10, 'edit')],
+			'//depot/Foo.c' : [(1, 'add'), (2, 'add'), (3, 'add'), (4, 'add'), (5, 'add'), (6, 'add'), (10, 'edit'), (11, 'edit')],
+		}, True)
+		self.assertEqual( [('//depot/bar.c', 'edit', 4, 'edit', 4, 1), ('//depot/Foo.c', 'edit', 7, 'edit', 8, 2)],
+			list(p4revert.netChanges(10, 11, set([10, 11]))) )
+
+	def testListFallsBackWhenTheListingIsNotInOrder(self):
+		self.useDepot({
+			'//depot/bar.c' : [(10, 'add')],
+			'//depot/Foo.c' : [(10, 'add'), (11, 'edit')],
+		}, True)
+		# Hand the listings out in byte order, not the order of the server.
+		self.depot.ignoreCase = False
+		self.assertEqual( ['//depot/bar.c', '//depot/Foo.c'],
+			[entry[0] for entry in p4revert.netChanges(10, 11, set([10, 11]))] )
+
+class PlanRevertTest(DepotTestCase):
+	def testAddIsDeleted(self):
+		self.useDepot({ '//depot/a.c' : [(10, 'add')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( (['//depot/a.c'], [], [], [], []), (deletes, edits, adds, resolves, warnings) )
+
+	def testEditIsEditedBack(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'edit')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( ([], [('//depot/a.c', 2)], [], ['//depot/a.c'], []), (deletes, edits, adds, resolves, warnings) )
+		self.assertEqual( '/ws/a.c', localNames['//depot/a.c'] )
+
+	def testDeleteIsAddedBack(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'delete')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( ([], [], [('//depot/a.c', 2)], ['//depot/a.c'], []), (deletes, edits, adds, resolves, warnings) )
+
+	def testNewBranchIsDeleted(self):
+		self.useDepot({ '//depot/a.c' : [(10, 'branch')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( (['//depot/a.c'], [], []), (deletes, edits, adds) )
+
+	def testBranchOnTopOfADeleteIsDeleted(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (2, 'delete'), (10, 'branch')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( (['//depot/a.c'], [], [], []), (deletes, edits, adds, resolves) )
+
+	def testIntegrateIsEditedBack(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'integrate')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( ([], [('//depot/a.c', 2)], ['//depot/a.c']), (deletes, edits, resolves) )
+
+	def testAddedAndDeletedInsideTheRangeIsLeftAlone(self):
+		self.useDepot({ '//depot/a.c' : [(10, 'add'), (11, 'delete')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10-11')
+		self.assertEqual( ([], [], [], []), (deletes, edits, adds, resolves) )
+
+	def testLaterEditIsLeftForAManualResolve(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'edit'), (20, 'edit')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( ([('//depot/a.c', 2)], []), (edits, resolves) )
+		self.assertEqual( 1, len(warnings) )
+		self.assertTrue( 'resolve manually' in warnings[0] )
+
+	def testLaterEditIsResolvedWhenForced(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'edit'), (20, 'edit')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10', True)
+		self.assertEqual( ([('//depot/a.c', 2)], ['//depot/a.c'], []), (edits, resolves, warnings) )
+
+	def testLaterEditOnTopOfADeleteIsNotDeleted(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (2, 'delete'), (10, 'branch'), (20, 'edit')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10')
+		self.assertEqual( [], deletes )
+		self.assertTrue( 'delete manually' in warnings[0] )
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10', True)
+		self.assertEqual( (['//depot/a.c'], []), (deletes, warnings) )
+
+	def testRangeUsesTheLastRevisionForLaterEdits(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'edit'), (11, 'edit')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10-11')
+		self.assertEqual( ([('//depot/a.c', 2)], ['//depot/a.c'], []), (edits, resolves, warnings) )
+
+	def testRevisionLeftOutOfAListIsALaterEdit(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'edit'), (11, 'edit'), (12, 'edit')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10,12')
+		self.assertEqual( ([('//depot/a.c', 2)], []), (edits, resolves) )
+		self.assertEqual( 1, len(warnings) )
+
+	def testDeleteAtTheEndOfTheRangeIsAddedBack(self):
+		self.useDepot({ '//depot/a.c' : [(1, 'add'), (10, 'edit'), (11, 'delete')] })
+		deletes, edits, adds, resolves, localNames, warnings = self.plan('10-11')
+		self.assertEqual( ([], [('//depot/a.c', 2)], ['//depot/a.c']), (edits, adds, resolves) )
+
+class BatchingTest(DepotTestCase):
+	def setUp(self):
+		DepotTestCase.setUp(self)
+		logging.disable(logging.WARNING)
+
+	def tearDown(self):
+		logging.disable(logging.NOTSET)
+		DepotTestCase.tearDown(self)
+
+	def revert(self, batchSize):
+		self.useDepot({
+			'//depot/a.c' : [(1, 'add'), (10, 'edit'), (11, 'edit')],
+			'//depot/b.c' : [(10, 'add')],
+			'//depot/c.c' : [(1, 'add'), (11, 'delete')],
+			'//depot/d.c' : [(1, 'add'), (10, 'edit'), (20, 'edit')],
+		})
+		p4revert.BATCH_SIZE = batchSize
+		failures = p4revert.revertChangelists(10, 11, None, False, False, 1)
+		operations = []
+		for command, arguments in self.depot.batches:
+			operations += [(command, argument) for argument in arguments]
+		return failures, sorted(operations)
+
+	def testResultDoesNotDependOnTheBatchSize(self):
+		failures, operations = self.revert(1000)
+		self.assertEqual( 0, failures )
+		self.assertEqual( (failures, operations), self.revert(1) )
+		self.assertTrue( ('resolve -ay', '//depot/a.c') in operations )
+		self.assertTrue( ('delete', '//depot/b.c') in operations )
+		self.assertTrue( ('add', '//depot/c.c') in operations )
+		self.assertFalse( ('resolve -ay', '//depot/d.c') in operations )
+
+if __name__ == '__main__':
+	unittest.main()